@@ -1,6 +1,10 @@
 from NeuralNetwork import NeuralNetwork
+from bitboard import state_bits
 import numpy as np
 
+# INPUTS[bits] is the 0/1 vector of the squares set in a 9-bit pattern
+INPUTS = ((np.arange(512)[:,None] >> np.arange(9)) & 1).astype(float)
+
 # A Neural Network tictacoe player
 class NNPlayer:
 
@@ -20,38 +24,39 @@ class NNPlayer:
     self.NN = NeuralNetwork()
     self.NN.load_from_file(fname)
 
-  # Receives a GameState and returns the position to play
+  # Receives a 3x3 game state and returns the position to play
   # Human must enter comma-separated row and column. (0,0) is upper left.
   def get_play(self, state):
 
-    invalues = np.zeros(9)
-    for i in range(3):
-      for j in range(2):
-        if state.grid[i][j] is None:
-          invalues[3*i+j] = 0
-        elif state.grid[i][j] == "X":
-          invalues[3*i+j] = +1
-        elif state.grid[i][j] == "O":
-          invalues[3*i+j] = -1
+    # The input is +1 for X, -1 for O and 0 for empty squares
+    xbits, obits = state_bits(state)
+    invalues = INPUTS[xbits] - INPUTS[obits]
 
     # Evaluate the network
     outvalues = self.NN.evaluate(invalues)
 
-    # Filter out and sort legals plays
-    legal_plays = state.get_legal_plays()
-    play_scores = []
-    for i in range(9):
-      pos = (i // 3, i % 3)
-      if pos in legal_plays:
-        play_scores.append((pos, outvalues[i]))
-    play_scores.sort(key=lambda x: x[1], reverse=True)
+    # Pick the legal play with the highest score
+    legal = INPUTS[xbits | obits] == 0
+    if not legal.any():
+      raise RuntimeError("No legal plays possible!")
+    scores = np.where(legal, outvalues, -np.inf)
+    best = int(np.argmax(scores))
 
     if self.debug:
       print("Play scores")
-      for play, score in play_scores:
-        print(play, "%.5f" % score)
+      for i in np.argsort(-scores, kind="stable"):
+        if legal[i]:
+          print((i // 3, i % 3), "%.5f" % scores[i])
+
+    return (best // 3, best % 3)
 
-    return play_scores[0][0]
+  # Batched policy with the interface of batchsim.py: receives an (N, 9)
+  # array of boards (+1 X, -1 O, 0 empty) and returns the square index to play
+  # on each, scoring all the boards with a single pass through the network
+  def batch_policy(self, boards, side, rng):
+    outvalues = self.NN.evaluate_batch(boards.astype(float))
+    outvalues[boards != 0] = -np.inf
+    return outvalues.argmax(axis=1)
 
 # ================================
 
@@ -1,6 +1,10 @@
 import random
+import struct
 import numpy as np
 
+# Magic bytes at the start of the binary network format
+BINARY_MAGIC = b"TTTNN\x00\x00\x01"
+
 class NeuralNetwork:
 
   # Class constructor takes two parameters:
@@ -21,41 +25,55 @@ class NeuralNetwork:
   # Initializes the NN
   # Separated from the constructor so it can also be called after
   # loading a definition from file
+  # All weights and biases live in the single flat array self.params, and
+  # self.weights[l] and self.biases[l] are views into it, so they must be
+  # modified in place (e.g. weights[l][...] = w) rather than reassigned
   def initialize(self):
     assert self.L is not None
     assert self.Ns is not None
+    self.bind_params(np.zeros(self.num_params()))
+
+  # Returns the total number of weights and biases
+  def num_params(self):
+    return sum(self.Ns[l]*self.Ns[l-1] + self.Ns[l] for l in range(1, self.L))
+
+  # Makes params the parameter buffer of the network and points the weights
+  # and biases at the corresponding slices of it, without copying
+  # The layout is, for each layer, the weight matrix (row-major) followed by
+  # the biases
+  def bind_params(self, params):
+    if params.shape != (self.num_params(),):
+      raise RuntimeError("Expected %i parameters, got shape %s" % (self.num_params(), params.shape))
+    self.params = params
     self.weights = []
     self.biases = []
+    i0 = 0
     for l in range(1, self.L):
-      self.weights.append(np.zeros((self.Ns[l], self.Ns[l-1])))
-      self.biases.append(np.zeros(self.Ns[l]))
+      M, N = self.Ns[l], self.Ns[l-1]
+      self.weights.append(params[i0:i0+M*N].reshape(M,N))
+      self.biases.append(params[i0+M*N:i0+M*N+M])
+      i0 += M*N + M
     self.wshape = self.weights[0].shape
 
   # Randomizes all weights
   def randomize(self):
     for l in range(self.L-1):
       M, N = self.weights[l].shape
-      self.weights[l] = np.random.rand(M, N)
+      self.weights[l][...] = np.random.rand(M, N)
 
   # Returns a "serialized" version of all weights and biases so that they
   # can be more easily fed to optimizations algorithms
-  def serialize(self):
-    serial = np.array([], dtype=self.weights[0].dtype)
-    for l in range(self.L-1):
-      M, N = self.weights[l].shape
-      serial = np.concatenate([serial, self.weights[l].reshape(M*N)])
-      serial = np.concatenate([serial, self.biases[l]])
-    return serial
-
-  # Unpacks and loads the serialized weights and biases
+  # This is the parameter buffer itself, or a copy of it if copy=True
+  def serialize(self, copy=True):
+    if copy:
+      return np.copy(self.params)
+    return self.params
+
+  # Loads the serialized weights and biases
+  # The array becomes the network's parameter buffer without being copied,
+  # so later changes to it are seen by the network
   def load_serialized(self, serial):
-    i0 = 0
-    for l in range(self.L-1):
-      M, N = self.weights[l].shape
-      K = len(self.biases[l])
-      self.weights[l] = serial[i0:i0+M*N].reshape(M,N)
-      self.biases[l] = serial[i0+M*N:i0+M*N+K]
-      i0 = M*N + K
+    self.bind_params(np.asarray(serial))
 
   # Saves the definition of the neural network to a file
   # Excluding comments:
@@ -76,8 +94,16 @@ class NeuralNetwork:
         f.write("%s\n" % " ".join("%f" % x for x in w[i,:]))
     f.close()
 
-  # Loads a NN definition from file
-  def load_from_file(self, fname):
+  # Loads a NN definition from file, in either the text format of
+  # save_to_file or the binary format of save_binary
+  # Text files carry no biases, so those are left at zero
+  def load_from_file(self, fname, mmap=False):
+    f = open(fname, "rb")
+    magic = f.read(len(BINARY_MAGIC))
+    f.close()
+    if magic == BINARY_MAGIC:
+      self.load_binary(fname, mmap=mmap)
+      return
     f = open(fname)
     f.readline()
     self.L = int(f.readline().strip())
@@ -89,9 +115,50 @@ class NeuralNetwork:
       shape = tuple(map(int, f.readline().strip().split()))
       M, N = shape
       for i in range(M):
-        row = list(map(float, f.readline().strip().split()))
-        for j in range(N):
-          self.weights[l][i,j] = row[j]
+        self.weights[l][i,:] = np.array(f.readline().split(), dtype=float)
+    f.close()
+
+  # Saves the neural network (weights and biases) in binary format
+  # The header holds the magic bytes, L and Ns (as uint32) and the numpy
+  # dtype string (4 bytes), padded to a multiple of 16 bytes; then for each
+  # layer the weight matrix (row-major) and the biases follow contiguously,
+  # in the same order as serialize()
+  def save_binary(self, fname):
+    dtype = self.params.dtype
+    header = BINARY_MAGIC
+    header += struct.pack("<I", self.L)
+    header += struct.pack("<%iI" % self.L, *self.Ns)
+    header += dtype.str.encode("ascii").ljust(4, b"\x00")
+    header = header.ljust(-(-len(header) // 16) * 16, b"\x00")
+    f = open(fname, "wb")
+    f.write(header)
+    f.write(np.ascontiguousarray(self.params).tobytes())
+    f.close()
+
+  # Loads a neural network saved with save_binary
+  # With mmap=True the file is memory-mapped (copy-on-write) instead of read,
+  # and the weights and biases are views into the mapping
+  def load_binary(self, fname, mmap=False):
+    f = open(fname, "rb")
+    if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+      raise RuntimeError("Not a binary network file: %s" % fname)
+    L, = struct.unpack("<I", f.read(4))
+    Ns = list(struct.unpack("<%iI" % L, f.read(4*L)))
+    dtype = np.dtype(f.read(4).rstrip(b"\x00").decode("ascii"))
+    offset = -(-f.tell() // 16) * 16
+    size = sum(Ns[l]*Ns[l-1] + Ns[l] for l in range(1, L))
+    if mmap:
+      f.close()
+      data = np.memmap(fname, dtype=dtype, mode="c", offset=offset, shape=(size,))
+    else:
+      f.seek(offset)
+      data = np.fromfile(f, dtype=dtype, count=size)
+      f.close()
+      if len(data) != size:
+        raise RuntimeError("Truncated binary network file: %s" % fname)
+    self.L = L
+    self.Ns = Ns
+    self.bind_params(data)
 
   # The activation function
   # Currently a logistic sigmoid
@@ -108,6 +175,15 @@ class NeuralNetwork:
       invals = outvals[:]
     return outvals
 
+  # Feedforward evaluation of many inputs at once
+  # X is an (N, Ns[0]) matrix with one input per row; returns the
+  # (N, Ns[L-1]) matrix of outputs
+  def evaluate_batch(self, X):
+    vals = X
+    for l in range(self.L-1):
+      vals = self.activation(vals @ self.weights[l].T + self.biases[l])
+    return vals
+
 # ===============================
 
 if __name__ == "__main__":
@@ -115,6 +191,7 @@ if __name__ == "__main__":
   NN = NeuralNetwork(L=3, Ns=[9,9,9])
   NN.randomize()
   NN.save_to_file("random.nn")
+  NN.save_binary("random.nnb")
 
   print(NN.weights[0], NN.weights[1], NN.biases)
 
@@ -0,0 +1,173 @@
+# Trains a neural network to play tic-tac-toe by supervised learning:
+# the network is fitted to the scores MinimaxPlayer gives to every play in
+# every reachable position, with mini-batch gradient descent
+import datetime
+import numpy as np
+from NeuralNetwork import NeuralNetwork
+from NNPlayer import NNPlayer, INPUTS
+from players import MinimaxPlayer
+from tictactoe import GameState
+from bitboard import POPCOUNT
+from solver import get_table, UNREACHABLE, TERNARY
+
+# ==================================
+
+# Builds the dataset of all reachable positions that aren't over
+# Returns (X, Y, M, best): X is the (P, 9) matrix of network inputs (as in
+# NNPlayer), Y the (P, 9) matrix of targets, M the (P, 9) boolean mask of
+# legal plays and best the (P, 9) boolean mask of the best plays
+# The target of a legal play is its MinimaxPlayer score (from the point of
+# view of the player to move) divided by 10, so it lies in (-1, 1); illegal
+# plays get a target of -1
+def build_dataset():
+
+  # The solver table is only used to list the reachable positions
+  table = get_table()
+  positions = []
+  for xbits in range(512):
+    for obits in range(512):
+      if xbits & obits:
+        continue
+      if table.value[TERNARY[xbits] + 2*TERNARY[obits]] == UNREACHABLE:
+        continue
+      positions.append((xbits, obits))
+
+  players = {"X": MinimaxPlayer(mark="X"), "O": MinimaxPlayer(mark="O")}
+  X = []
+  Y = []
+  M = []
+  best = []
+  for xbits, obits in positions:
+    state = GameState.from_bits(xbits, obits)
+    if state.get_winner() is not None:
+      continue
+    mark = "X" if POPCOUNT[xbits] == POPCOUNT[obits] else "O"
+    play_scores = players[mark].score_plays(state)
+    best_score = max(score for play, score in play_scores)
+    y = -np.ones(9)
+    b = np.zeros(9, dtype=bool)
+    for (i,j), score in play_scores:
+      y[3*i+j] = score / 10
+      b[3*i+j] = score == best_score
+    X.append(INPUTS[xbits] - INPUTS[obits])
+    Y.append(y)
+    M.append(INPUTS[xbits | obits] == 0)
+    best.append(b)
+
+  return np.array(X), np.array(Y), np.array(M), np.array(best)
+
+# =====================================
+
+# Fits a NeuralNetwork to the minimax dataset
+# Ns: number of neurons of each layer (9 inputs and 9 outputs)
+# epochs, batch_size, learning_rate: settings of the Adam optimizer
+# masked: if True only the outputs of legal plays count in the loss
+# seed: for the initial weights and the shuffling of the batches
+class SupervisedTrainer:
+
+  def __init__(self, Ns=[9,128,128,9], epochs=300, batch_size=128, learning_rate=0.002, masked=True, seed=None):
+    self.Ns = list(Ns)
+    self.epochs = epochs
+    self.batch_size = batch_size
+    self.learning_rate = learning_rate
+    self.masked = masked
+    self.rng = np.random.default_rng(seed)
+    self.dataset = None
+
+  # Returns the mean squared error of the network outputs over the targets
+  # (and its gradient with respect to the parameters, if grad is a buffer
+  # laid out like NN.params)
+  # The gradient assumes the tanh activation of NeuralNetwork
+  def loss(self, NN, X, Y, M, grad=None):
+
+    # Forward pass, keeping the activations of every layer
+    acts = [X]
+    for l in range(NN.L-1):
+      acts.append(NN.activation(acts[-1] @ NN.weights[l].T + NN.biases[l]))
+
+    # Squared error of the outputs that count
+    weights = M if self.masked else np.ones_like(M)
+    count = weights.sum()
+    err = (acts[-1] - Y) * weights
+    loss = (err**2).sum() / (2*count)
+    if grad is None:
+      return loss
+
+    # Backward pass, filling the gradient buffer layer by layer through a
+    # network bound to it
+    G = NeuralNetwork(L=NN.L, Ns=NN.Ns)
+    G.bind_params(grad)
+    delta = err * (1 - acts[-1]**2) / count
+    for l in range(NN.L-2, -1, -1):
+      G.weights[l][...] = delta.T @ acts[l]
+      G.biases[l][...] = delta.sum(axis=0)
+      if l > 0:
+        delta = (delta @ NN.weights[l]) * (1 - acts[l]**2)
+    return loss
+
+  # Trains a new network and returns it
+  def train(self, report=True):
+
+    start = datetime.datetime.now()
+    if self.dataset is None:
+      if report: print("Building dataset ...")
+      self.dataset = build_dataset()
+    X, Y, M, best = self.dataset
+    if report: print("{:,} positions".format(len(X)))
+
+    # Small random initial weights
+    NN = NeuralNetwork(L=len(self.Ns), Ns=self.Ns)
+    for l in range(NN.L-1):
+      M_, N_ = NN.weights[l].shape
+      NN.weights[l][...] = self.rng.normal(0, 1/np.sqrt(N_), (M_, N_))
+
+    # Adam optimizer state, laid out like the parameter buffer
+    grad = np.zeros_like(NN.params)
+    m = np.zeros_like(NN.params)
+    v = np.zeros_like(NN.params)
+    beta1, beta2, eps = 0.9, 0.999, 1e-8
+    t = 0
+
+    for epoch in range(1, self.epochs+1):
+      order = self.rng.permutation(len(X))
+      for first in range(0, len(X), self.batch_size):
+        idx = order[first:first+self.batch_size]
+        self.loss(NN, X[idx], Y[idx], M[idx], grad)
+        t += 1
+        m = beta1*m + (1 - beta1)*grad
+        v = beta2*v + (1 - beta2)*grad**2
+        mhat = m / (1 - beta1**t)
+        vhat = v / (1 - beta2**t)
+        NN.params -= self.learning_rate * mhat / (np.sqrt(vhat) + eps)
+      if report and (epoch % max(1, self.epochs//10) == 0 or epoch == self.epochs):
+        loss = self.loss(NN, X, Y, M)
+        print("Epoch %i: loss %.6f, accuracy %.4f" % (epoch, loss, self.accuracy(NN)))
+
+    if report:
+      elapsed = (datetime.datetime.now() - start).total_seconds()
+      print("Elapsed: %.1fs" % elapsed)
+    return NN
+
+  # Returns the fraction of positions where the network's choice (its best
+  # scored legal play, as NNPlayer picks it) is one of the best plays
+  def accuracy(self, NN):
+    X, Y, M, best = self.dataset
+    out = NN.evaluate_batch(X)
+    out[~M] = -np.inf
+    choice = out.argmax(axis=1)
+    return best[np.arange(len(X)), choice].mean()
+
+# ============================================
+
+if __name__ == "__main__":
+
+  from trials import evaluate_player
+
+  trainer = SupervisedTrainer(seed=0)
+  NN = trainer.train()
+  NN.save_binary("supervised.nnb")
+  print("Saved network to supervised.nnb")
+
+  player = NNPlayer(NN=NN)
+  strength, wins, ties, losses, elapsed = evaluate_player(player, 0, exact=True)
+  print("Exact strength vs. RandomPlayer: %.5f (loss probability %.5f)" % (strength, losses))
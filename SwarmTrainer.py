@@ -1,10 +1,18 @@
 # Trains a neural network to play tic-tac-toe using Particle
 # Swarm Optimization
+import hashlib
+import json
+import multiprocessing
+import os
 import random
+import time
+from collections import OrderedDict
 import numpy as np
 from NeuralNetwork import NeuralNetwork
 from NNPlayer import NNPlayer
 from trials import evaluate_player
+from batchsim import evaluate_policy
+from instrument import Stats
 
 # ==================================
 
@@ -13,40 +21,52 @@ xi = 0.72984
 c1 = 2.05
 c2 = 2.05
 
-# The particles, yo
+# A whole swarm held as arrays, one row per particle, so that each PSO
+# operation is a single vectorized update instead of a loop over particles
 # Note that fitness calculation has been outsourced to the trainer class
 # so that it can be computed in parallel
-class Particle:
+# pos, vel, best_pos: (P, D) matrices of positions, velocities and the best
+#   position each particle has seen
+# fitness, best_fit: (P,) vectors of current and best fitness
+# neighbors: (P, K) matrix with the indices of each particle's neighbors
+# rng: the numpy random Generator used for the updates
+class Swarm:
 
-  def __init__(self, pos=None, vel=None):
-    if pos is None:
-      self.pos = None
-    else:
-      self.pos = np.copy(pos)
+  def __init__(self, pos, vel=None, rng=None):
+    self.pos = np.array(pos, dtype=float)
     if vel is None:
-      self.vel = None
+      self.vel = np.zeros_like(self.pos)
     else:
-      self.vel = np.copy(vel)
-    self.fitness = None
+      self.vel = np.array(vel, dtype=float)
+    self.num_parts, self.dim = self.pos.shape
+    self.fitness = np.full(self.num_parts, np.nan)
+    self.best_pos = np.copy(self.pos)
+    self.best_fit = np.full(self.num_parts, -np.inf)
     self.neighbors = None
-    self.best_pos = None
-    self.best_fit = None
+    if rng is None:
+      rng = np.random.default_rng()
+    self.rng = rng
+
+  # Gives each particle num_neighs neighbors chosen at random among the
+  # other particles (possibly repeated)
+  def set_random_neighbors(self, num_neighs):
+    neighbors = self.rng.integers(0, self.num_parts-1, size=(self.num_parts, num_neighs))
+    # Skip over the particle itself
+    neighbors += neighbors >= np.arange(self.num_parts)[:,None]
+    self.neighbors = neighbors
 
-  # Update the particle velocity
+  # Updates the velocities of all particles
   # Assumes fitness of all particles has been computed
   def update_vel(self):
 
     # Obtain best pos of neighbors
-    best_npos = None
-    best_nfit = None
-    for neigh in self.neighbors:
-      if best_npos is None or neigh.fitness > best_nfit:
-        best_nfit = neigh.fitness
-        best_npos = neigh.pos
+    rows = np.arange(self.num_parts)
+    best_neighs = self.neighbors[rows, np.argmax(self.fitness[self.neighbors], axis=1)]
+    best_npos = self.pos[best_neighs]
 
     # The update
-    e1 = np.random.random(self.vel.shape)
-    e2 = np.random.random(self.vel.shape)
+    e1 = self.rng.random(self.pos.shape)
+    e2 = self.rng.random(self.pos.shape)
     self.vel = \
       xi * ( \
       self.vel \
@@ -54,17 +74,52 @@ class Particle:
       + c2 * e2 * (best_npos - self.pos) \
       )
 
-  # Moves the particle (only)
-  # Assumes velocity is updated
+  # Moves all the particles
+  # Assumes velocities are updated
   def move(self):
-    self.pos = self.pos + self.vel
+    self.pos += self.vel
 
-  # Updates the best position the particle has seen so far
-  # Assumes fitness for the current position has been calculated
+  # Updates the best position each particle has seen so far
+  # Assumes fitness for the current positions has been calculated
   def update_best_pos(self):
-    if self.best_pos is None or self.fitness > self.best_fit:
-      self.best_fit = self.fitness
-      self.best_pos = self.pos
+    better = self.fitness > self.best_fit
+    self.best_fit[better] = self.fitness[better]
+    self.best_pos[better] = self.pos[better]
+
+# Returns the NNPlayer of a particle at position pos (a serialized network)
+def particle_player(pos):
+  NN = NeuralNetwork(L=3, Ns=[9,9,9])
+  NN.load_serialized(pos)
+  return NNPlayer(NN=NN)
+
+# Evaluates the fitness of a particle at position pos (a serialized network)
+# by playing num_games games; seed is passed to the evaluation
+# The games are recorded in stats if given (batched games only as a total)
+# A module-level function so that it can be run by the pool workers
+def particle_fitness(pos, num_games, batched=False, seed=None, stats=None):
+  player = particle_player(pos)
+  if batched:
+    results = evaluate_policy(player.batch_policy, num_games, seed=seed)
+    if stats is not None:
+      stats.record_games(num_games, results[4])
+  else:
+    results = evaluate_player(player, num_games, seed=seed, stats=stats)
+  strength = results[0]
+  # Hack to prevent weight explosion
+  # if np.sum(np.abs(NN.weights[0])) > 1800 or np.sum(np.abs(NN.weights[1])) > 1800:
+  #   strength = 0
+  return strength
+
+# Entry point of the pool workers in PSOTrainer
+# Returns the fitness and the Stats of the evaluation (None if not profiling)
+def _particle_fitness_task(args):
+  pos, num_games, batched, seed, profile = args
+  stats = Stats() if profile else None
+  return particle_fitness(pos, num_games, batched, seed, stats), stats
+
+# Returns the seed for the fitness evaluation of particle i at step step
+def fitness_seed(seed, step, i):
+  return (seed << 40) + (step << 20) + i
 
 # Receives a NNagent and uses the PSO algorithm to train it
 class PSOTrainer:
@@ -73,97 +128,302 @@ class PSOTrainer:
   # num_parts is the number of particles to use
   # num_neighs is the number of neighbors each particle has
   # num_games is the number of games used to determine the win ratio
-  def __init__(self, num_steps=1000, num_parts=100, num_neighs=5, num_games=100000):
+  # batched plays the games with the vectorized engine of batchsim.py
+  # workers is the number of processes that evaluate fitness in parallel
+  # seed makes the training reproducible, for any number of workers
+  # checkpoint_every is the number of steps between checkpoints of the whole
+  # swarm to checkpoint_file (0 to disable)
+  # fitness_cache_size is the number of fitness values remembered by
+  # position, so particles that haven't moved aren't evaluated again
+  # (0 to disable)
+  # evaluator is an optional adaptive.AdaptiveEvaluator that replaces the
+  # fixed num_games evaluation; all particles of a step are raced with the
+  # same seed
+  # stats is an optional instrument.Stats that collects the games of the
+  # fitness evaluations, the fitness cache hits and the time spent in each
+  # phase of the steps; its summary is printed at the end of the training
+  def __init__(self, num_steps=1000, num_parts=100, num_neighs=5, num_games=100000, batched=False, workers=1, seed=None, checkpoint_every=10, checkpoint_file="swarm_checkpoint.npz", fitness_cache_size=10000, evaluator=None, stats=None):
     self.num_steps = num_steps
     self.num_parts = num_parts
     self.num_games = num_games
     self.num_neighs = num_neighs
-    self.particles = []
-
-  # Evaluates the fitness of the particle
-  def eval_fitness(self, particle):
-    NN = NeuralNetwork(L=3, Ns=[9,9,9])
-    NN.load_serialized(particle.pos)
-    player = NNPlayer(NN=NN)
-    results = evaluate_player(player, self.num_games)
-    strength = results[0]
-    # Hack to prevent weight explosion
-    # if np.sum(np.abs(NN.weights[0])) > 1800 or np.sum(np.abs(NN.weights[1])) > 1800:
-    #   strength = 0
-    return strength
+    self.batched = batched
+    self.workers = workers
+    self.seed = seed
+    self.checkpoint_every = checkpoint_every
+    self.checkpoint_file = checkpoint_file
+    self.fitness_cache_size = fitness_cache_size
+    self.evaluator = evaluator
+    self.stats = stats
+    self.fitness_cache = OrderedDict()
+    self.cache_hits = 0
+    self.cache_misses = 0
+    self.swarm = None
+    self.pool = None
 
-  # The actual training routine
-  def train(self):
+  # Evaluates the fitness of particle i of the swarm at its current position
+  def eval_fitness(self, i, seed=None):
+    return particle_fitness(self.swarm.pos[i], self.num_games, self.batched, seed, self.stats)
 
-    # Create particles (with random NNs)
-    print("Creating particles ...")
+  # Evaluates the fitness of all the particles at the given step, in the
+  # pool if there is one
+  # Each evaluation gets its own seed derived from the trainer's seed, so the
+  # results don't depend on which worker runs it
+  # Positions found in the fitness cache (or repeated within the step) are
+  # only evaluated once
+  def eval_all_fitness(self, step):
+    self.cache_hits = 0
+    self.cache_misses = 0
+    keys = [self.fitness_key(pos) for pos in self.swarm.pos]
+    fits = [None] * self.num_parts
+    tasks = []
+    task_keys = {}
     for i in range(self.num_parts):
-      p = Particle()
-      NN = NeuralNetwork(L=3, Ns=[9,9,9])
-      NN.randomize()
-      p.pos = NN.serialize()
-      #p.vel = np.random.rand(len(p.pos))
-      p.vel = np.zeros(len(p.pos))
-      self.particles.append(p)
-
-    # Randomly set neighbors
-    print("Setting neighbors ...")
+      fit = self.cache_lookup(keys[i])
+      if fit is not None:
+        fits[i] = fit
+        self.cache_hits += 1
+      elif keys[i] in task_keys:
+        self.cache_hits += 1
+      else:
+        seed = None if self.seed is None else fitness_seed(self.seed, step, i)
+        tasks.append((self.swarm.pos[i], self.num_games, self.batched, seed, self.stats is not None))
+        task_keys[keys[i]] = len(tasks) - 1
+        self.cache_misses += 1
+    if self.stats is not None:
+      self.stats.count("PSOTrainer.fitness_cache_hits", self.cache_hits)
+      self.stats.count("PSOTrainer.fitness_cache_misses", self.cache_misses)
+    if self.evaluator is not None:
+      task_fits = self.race_fitness(step, [task[0] for task in tasks])
+    else:
+      if self.pool is not None:
+        task_results = self.pool.map(_particle_fitness_task, tasks)
+      else:
+        task_results = [_particle_fitness_task(task) for task in tasks]
+      task_fits = []
+      for fit, task_stats in task_results:
+        task_fits.append(fit)
+        if task_stats is not None:
+          self.stats.merge(task_stats)
+    new_fits = {key: task_fits[j] for key, j in task_keys.items()}
     for i in range(self.num_parts):
-      particle = self.particles[i]
-      particle.neighbors = []
-      while len(particle.neighbors) < self.num_neighs:
-        neigh = random.choice(self.particles)
-        if neigh is not particle:
-          particle.neighbors.append(neigh)
-
-    # Evaluate initial fitness
-    print("Initializing ...")
-    fits = []
-    for i,particle in enumerate(self.particles):
-      particle.fitness = self.eval_fitness(particle)
-      particle.update_best_pos()
-      fits.append(particle.fitness)
-    print("Max fitness: %.5f" % max(fits))
-    print("Avg fitness: %.5f" % np.mean(fits))
-    print("Min fitness: %.5f" % min(fits))
-    print("Std fitness: %.5f" % np.std(fits))
+      if fits[i] is None:
+        fits[i] = new_fits[keys[i]]
+    for key, fit in new_fits.items():
+      self.cache_store(key, fit)
+    self.swarm.fitness[:] = fits
+    return fits
+
+  # Evaluates the particles at positions with the adaptive evaluator
+  # They all use the same seed, so they face the same opponent random
+  # numbers (a seed is drawn for the step if the trainer has none)
+  def race_fitness(self, step, positions):
+    if self.seed is None:
+      seed = random.randrange(2**32)
+    else:
+      seed = fitness_seed(self.seed, step, 0)
+    players = [particle_player(pos) for pos in positions]
+    results = self.evaluator.race(players, seed=seed, pool=self.pool)
+    print("Adaptive evaluation: %i games" % sum(result[4] for result in results))
+    return [result[0] for result in results]
+
+  # Returns the fitness cache key of a position: a hash of the parameters
+  # and of the settings of the evaluation
+  def fitness_key(self, pos):
+    h = hashlib.sha1(np.ascontiguousarray(pos).tobytes())
+    h.update(b"%i %i" % (self.num_games, self.batched))
+    if self.evaluator is not None:
+      h.update(self.evaluator.config().encode())
+    return h.digest()
+
+  # Returns the cached fitness for key (marking it as recently used), or
+  # None if it's not in the cache
+  def cache_lookup(self, key):
+    fit = self.fitness_cache.get(key)
+    if fit is not None:
+      self.fitness_cache.move_to_end(key)
+    return fit
+
+  # Stores a fitness in the cache, evicting the least recently used entries
+  # beyond fitness_cache_size
+  def cache_store(self, key, fit):
+    if self.fitness_cache_size <= 0:
+      return
+    self.fitness_cache[key] = fit
+    self.fitness_cache.move_to_end(key)
+    while len(self.fitness_cache) > self.fitness_cache_size:
+      self.fitness_cache.popitem(last=False)
+
+  # The actual training routine
+  # resume_from is a checkpoint file written by a previous run; training
+  # continues from the step after it, exactly as the original run would have
+  def train(self, resume_from=None):
+
+    if resume_from is not None:
+      first_step = self.load_checkpoint(resume_from) + 1
+    else:
+      first_step = 1
+
+    if self.workers > 1:
+      # Workers start from copies of the same random state, so evaluations
+      # must always be seeded
+      if self.seed is None:
+        self.seed = random.randrange(2**32)
+      self.pool = multiprocessing.Pool(self.workers)
+    if self.seed is not None and resume_from is None:
+      random.seed(self.seed)
+      np.random.seed(self.seed % 2**32)
+
+    try:
+      self.run(first_step)
+    finally:
+      if self.pool is not None:
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+
+  # The PSO iterations, starting at first_step
+  # The swarm is created unless it was loaded from a checkpoint
+  def run(self, first_step=1):
+
+    if self.swarm is None:
+
+      # Create particles (with random NNs)
+      print("Creating particles ...")
+      positions = []
+      for i in range(self.num_parts):
+        NN = NeuralNetwork(L=3, Ns=[9,9,9])
+        NN.randomize()
+        positions.append(NN.serialize())
+      self.swarm = Swarm(positions, rng=np.random.default_rng(self.seed))
+
+      # Randomly set neighbors
+      print("Setting neighbors ...")
+      self.swarm.set_random_neighbors(self.num_neighs)
+
+      # Evaluate initial fitness
+      print("Initializing ...")
+      self.eval_all_fitness(0)
+      self.swarm.update_best_pos()
+      self.print_fitness()
 
     # Main loop
+    # All particles move before any fitness is evaluated, so that the
+    # evaluations of a step can run in parallel
     print("\nTRAINING ...")
-    for step in range(1,self.num_steps+1):
+    for step in range(first_step,self.num_steps+1):
 
       print("\nStep %i" % step)
 
-      for i,particle in enumerate(self.particles):
-        particle.update_vel()
-        particle.move()
-        particle.fitness = self.eval_fitness(particle)
-        particle.update_best_pos()
-        if i % 1 == 0:
-          print("=", end="", flush=True)
-      print()
-
-      best_part = None
-      best_fit = None
-      fits = []
-      for particle in self.particles:
-        fits.append(particle.fitness)
-        if best_fit is None or particle.fitness > best_fit:
-          best_fit = particle.fitness
-          best_part = particle
-      print("Max fitness: %.5f" % max(fits))
-      print("Avg fitness: %.5f" % np.mean(fits))
-      print("Min fitness: %.5f" % min(fits))
-      print("Std fitness: %.5f" % np.std(fits))
+      stats = self.stats
+      if stats is not None:
+        phase_start = time.perf_counter()
+      self.swarm.update_vel()
+      self.swarm.move()
+      if stats is not None:
+        stats.record_time("PSOTrainer.move", time.perf_counter() - phase_start)
+        phase_start = time.perf_counter()
+      self.eval_all_fitness(step)
+      if stats is not None:
+        stats.record_time("PSOTrainer.fitness", time.perf_counter() - phase_start)
+      self.swarm.update_best_pos()
+      self.print_fitness()
 
       outfname = "swarm_%03i.nn" % step
+      best_part = np.argmax(self.swarm.fitness)
       NN = NeuralNetwork(L=3, Ns=[9,9,9])
-      NN.load_serialized(best_part.pos)
+      NN.load_serialized(self.swarm.pos[best_part])
       NN.save_to_file(outfname)
       print("Saved best to %s" % outfname)
 
+      if self.checkpoint_every > 0 and step % self.checkpoint_every == 0:
+        if stats is not None:
+          phase_start = time.perf_counter()
+        self.save_checkpoint(step)
+        if stats is not None:
+          stats.record_time("PSOTrainer.checkpoint", time.perf_counter() - phase_start)
+        print("Saved checkpoint to %s" % self.checkpoint_file)
+
+    if self.stats is not None:
+      print("\nProfile:")
+      print(self.stats.summary())
+
+  # Saves the full state of the training after the given step to
+  # checkpoint_file: the swarm arrays, the neighbor topology, the random
+  # states, the fitness cache and the settings that determine the run
+  # The file is replaced atomically, so a run killed while saving still
+  # leaves the previous checkpoint intact
+  def save_checkpoint(self, step):
+    swarm = self.swarm
+    rng_state = swarm.rng.bit_generator.state
+    py_state = random.getstate()
+    tmpfname = self.checkpoint_file + ".tmp"
+    f = open(tmpfname, "wb")
+    np.savez(f,
+      step=step,
+      num_parts=self.num_parts,
+      num_neighs=self.num_neighs,
+      num_games=self.num_games,
+      batched=self.batched,
+      seed=-1 if self.seed is None else self.seed,
+      pos=swarm.pos,
+      vel=swarm.vel,
+      fitness=swarm.fitness,
+      best_pos=swarm.best_pos,
+      best_fit=swarm.best_fit,
+      neighbors=swarm.neighbors,
+      rng_state=json.dumps(rng_state),
+      py_random_state=json.dumps(py_state),
+      cache_keys=np.frombuffer(b"".join(self.fitness_cache.keys()), dtype=np.uint8).reshape(-1, 20),
+      cache_fits=np.array(list(self.fitness_cache.values()), dtype=float),
+    )
+    f.close()
+    os.replace(tmpfname, self.checkpoint_file)
+
+  # Loads a checkpoint written by save_checkpoint, restoring the swarm and
+  # the random states; returns the step it was taken after
+  def load_checkpoint(self, fname):
+    data = np.load(fname)
+    if int(data["num_parts"]) != self.num_parts or int(data["num_neighs"]) != self.num_neighs:
+      raise RuntimeError("Checkpoint %s has a different swarm size!" % fname)
+    self.num_games = int(data["num_games"])
+    self.batched = bool(data["batched"])
+    seed = int(data["seed"])
+    self.seed = None if seed == -1 else seed
+
+    rng_state = json.loads(str(data["rng_state"]))
+    bit_generator = getattr(np.random, rng_state["bit_generator"])()
+    bit_generator.state = rng_state
+    swarm = Swarm(data["pos"], data["vel"], rng=np.random.Generator(bit_generator))
+    swarm.fitness[:] = data["fitness"]
+    swarm.best_pos[:] = data["best_pos"]
+    swarm.best_fit[:] = data["best_fit"]
+    swarm.neighbors = np.array(data["neighbors"])
+    self.swarm = swarm
+
+    version, internal, gauss = json.loads(str(data["py_random_state"]))
+    random.setstate((version, tuple(internal), gauss))
+
+    # Cache entries are stored from least to most recently used
+    self.fitness_cache = OrderedDict()
+    for key, fit in zip(data["cache_keys"], data["cache_fits"]):
+      self.fitness_cache[key.tobytes()] = float(fit)
+
+    return int(data["step"])
+
+  # Prints statistics of the current fitness of the swarm
+  def print_fitness(self):
+    fits = self.swarm.fitness
+    print("Max fitness: %.5f" % np.max(fits))
+    print("Avg fitness: %.5f" % np.mean(fits))
+    print("Min fitness: %.5f" % np.min(fits))
+    print("Std fitness: %.5f" % np.std(fits))
+    print("Fitness cache: %i hits, %i misses" % (self.cache_hits, self.cache_misses))
+
 
 # ============================================
 
-trainer = PSOTrainer(num_parts=50, num_games=1000)
-trainer.train()
+if __name__ == "__main__":
+
+  trainer = PSOTrainer(num_parts=50, num_games=1000, workers=multiprocessing.cpu_count())
+  trainer.train()
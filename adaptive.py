@@ -0,0 +1,145 @@
+# Adaptive evaluation of player strength, built on trials.evaluate_player
+# Instead of a fixed number of games, players are evaluated in batches until
+# the confidence interval of their strength is narrow enough, so clearly bad
+# or clearly good players need few games and close ones get more
+# All players evaluated with the same seed face the same starting sides and
+# opponent random numbers game by game (common random numbers), which makes
+# differences between them less noisy than independent evaluations
+# In racing mode several players are evaluated together, and those that are
+# clearly worse than the best ones stop being evaluated
+import math
+from statistics import NormalDist
+from players import RandomPlayer
+from trials import evaluate_player
+
+# ==============================================================================
+
+# Running results of the evaluation of one player
+class Tally:
+
+  def __init__(self):
+    self.wins = 0
+    self.ties = 0
+    self.losses = 0
+    self.dropped = False
+
+  # Adds the results of a batch of games
+  def add(self, wins, ties, losses):
+    self.wins += wins
+    self.ties += ties
+    self.losses += losses
+
+  # Number of games played
+  @property
+  def games(self):
+    return self.wins + self.ties + self.losses
+
+  # The measured strength: the mean score per game (1 win, 1/2 tie, 0 loss)
+  @property
+  def strength(self):
+    return (self.wins + self.ties/2) / self.games
+
+  # Half-width of the normal-approximation confidence interval of the
+  # strength, with the given z value
+  # One pseudo-tie is added to the counts so that players that won (or
+  # lost) every game so far don't get a zero-width interval
+  def halfwidth(self, z):
+    n = self.games + 1
+    mean = (self.wins + (self.ties + 1)/2) / n
+    var = (self.wins + (self.ties + 1)/4) / n - mean**2
+    return z * math.sqrt(max(var, 0) / n)
+
+# =====================================
+
+# Evaluates players adaptively
+# batch_games: number of games played per player per round
+# min_games, max_games: bounds on the number of games per player
+# tolerance: half-width of the confidence interval at which to stop
+# confidence: confidence level of the intervals
+# opponent: opponent of the evaluations (a RandomPlayer by default)
+# racing, keep: whether race() drops players that can't make the top keep
+class AdaptiveEvaluator:
+
+  def __init__(self, batch_games=50, min_games=50, max_games=5000, tolerance=0.02, confidence=0.95, opponent=None, racing=False, keep=1):
+    self.batch_games = batch_games
+    self.min_games = min_games
+    self.max_games = max_games
+    self.tolerance = tolerance
+    self.confidence = confidence
+    self.z = NormalDist().inv_cdf((1 + confidence) / 2)
+    if opponent is None:
+      opponent = RandomPlayer(quiet=True)
+    self.opponent = opponent
+    self.racing = racing
+    self.keep = keep
+
+  # Returns a string with the settings, to tell apart evaluations made with
+  # different evaluators
+  def config(self):
+    return "%i %i %i %g %g %s %i %i" % (self.batch_games, self.min_games, self.max_games,
+      self.tolerance, self.confidence, self.opponent.name, self.racing, self.keep)
+
+  # Evaluates a single player, stopping when the confidence interval is
+  # narrower than the tolerance
+  # Returns (strength, wins, ties, losses, games)
+  def evaluate(self, player, seed=None):
+    results = self.race([player], seed=seed)
+    return results[0]
+
+  # Evaluates several players together
+  # Every round, each active player plays a batch of games with the same
+  # seed, every game seeded from (seed, batch, game number) so that they line
+  # up even when the players' games have different lengths; a player stops
+  # when its interval is narrower than the tolerance
+  # If racing, players whose upper bound falls below the lower bound of the
+  # keep-th best player are dropped, as they can't make the top keep
+  # The batches of a round are run in pool, if given
+  # Returns a list with (strength, wins, ties, losses, games) for each player
+  def race(self, players, seed=None, pool=None):
+
+    tallies = [Tally() for player in players]
+    active = list(range(len(players)))
+    batch = 0
+    while len(active) > 0:
+
+      # Play a batch with every active player
+      batch_seed = None if seed is None else (seed << 20) + batch
+      tasks = [(players[i], self.batch_games, self.opponent, batch_seed) for i in active]
+      if pool is not None:
+        batch_results = pool.map(_evaluate_batch_task, tasks)
+      else:
+        batch_results = [_evaluate_batch_task(task) for task in tasks]
+      for i, (wins, ties, losses) in zip(active, batch_results):
+        tallies[i].add(wins, ties, losses)
+      batch += 1
+
+      # Drop the players that are clearly out of the top
+      keep = self.keep
+      if self.racing and len(players) > keep:
+        lowers = sorted((tallies[i].strength - tallies[i].halfwidth(self.z)
+          for i in range(len(players)) if not tallies[i].dropped), reverse=True)
+        if len(lowers) > keep:
+          threshold = lowers[keep-1]
+          for i in active:
+            tally = tallies[i]
+            if tally.games >= self.min_games and tally.strength + tally.halfwidth(self.z) < threshold:
+              tally.dropped = True
+
+      # Stop the players that are done
+      still_active = []
+      for i in active:
+        tally = tallies[i]
+        if tally.dropped or tally.games >= self.max_games:
+          continue
+        if tally.games >= self.min_games and tally.halfwidth(self.z) <= self.tolerance:
+          continue
+        still_active.append(i)
+      active = still_active
+
+    return [(t.strength, t.wins, t.ties, t.losses, t.games) for t in tallies]
+
+# Plays a batch of games for AdaptiveEvaluator.race, in a pool worker or not
+def _evaluate_batch_task(args):
+  player, num_games, opponent, seed = args
+  results = evaluate_player(player, num_games, opponent=opponent, seed=seed, seed_block=1)
+  return results[1:4]
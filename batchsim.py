@@ -0,0 +1,183 @@
+# Vectorized tic-tac-toe engine that plays many games at once
+# Boards are held as an (N, 9) int8 array with +1 for X, -1 for O and 0 for
+# empty squares, square k = 3*i + j
+# A policy is a function policy(boards, side, rng) that receives the boards
+# of the unfinished games, the side to play (+1 or -1) and a numpy random
+# Generator, and returns the square index to play on each board
+import datetime
+import numpy as np
+from bitboard import WIN_MASKS
+from solver import get_table
+
+# ==============================================================================
+
+# The squares of each of the 8 winning lines, shape (8, 3)
+LINES = np.array([[k for k in range(9) if m >> k & 1] for m in WIN_MASKS])
+
+# Line-square incidence matrix: INCIDENCE[l,k] is 1 if square k is on line l
+INCIDENCE = np.zeros((8, 9), dtype=np.int8)
+for l in range(8):
+  INCIDENCE[l, LINES[l]] = 1
+
+# Powers of 3 for the base-3 board index (empty 0, X 1, O 2) used by solver
+POW3 = 3**np.arange(9)
+
+# Square indices, for unpacking bitmasks of squares
+SQUARES = np.arange(9)
+
+# Returns the (N, 8) sums of each line on each board
+def line_sums(boards):
+  return boards[:, LINES].sum(axis=2, dtype=np.int8)
+
+# Returns the (N,) winner of each board: +1, -1, or 0 if nobody has won
+def get_winners(boards):
+  sums = line_sums(boards)
+  winners = np.zeros(len(boards), dtype=np.int8)
+  winners[(sums == 3).any(axis=1)] = 1
+  winners[(sums == -3).any(axis=1)] = -1
+  return winners
+
+# Returns the (N, 9) boolean mask of empty squares
+def legal_mask(boards):
+  return boards == 0
+
+# Returns the (N, 9) boolean mask of the squares where side completes a line
+def winning_mask(boards, side):
+  threats = (line_sums(boards) == 2*side).astype(np.int8)
+  return (threats @ INCIDENCE > 0) & (boards == 0)
+
+# Returns a random square among those set in mask (N, 9) for each board,
+# by taking the argmax of random keys over the allowed squares
+def random_choice(mask, rng):
+  keys = rng.random(mask.shape)
+  keys[~mask] = -1
+  return keys.argmax(axis=1)
+
+# Returns the base-3 index of each board in the solver table
+def board_indices(boards):
+  return (boards % 3) @ POW3
+
+# =====================================
+# Built-in policies, matching the agents in players.py
+
+# Plays at random
+def random_policy(boards, side, rng):
+  return random_choice(legal_mask(boards), rng)
+
+# Plays the first winning square if there is one, randomly otherwise
+def opportunist_policy(boards, side, rng):
+  wins = winning_mask(boards, side)
+  plays = random_policy(boards, side, rng)
+  has_win = wins.any(axis=1)
+  plays[has_win] = wins[has_win].argmax(axis=1)
+  return plays
+
+# Blocks the first square where the opponent would win, randomly otherwise
+def blocking_policy(boards, side, rng):
+  blocks = winning_mask(boards, -side)
+  plays = random_policy(boards, side, rng)
+  has_block = blocks.any(axis=1)
+  plays[has_block] = blocks[has_block].argmax(axis=1)
+  return plays
+
+# Plays the first winning square if there is one, else blocks the first
+# square where the opponent would win, randomly otherwise
+def winblock_policy(boards, side, rng):
+  plays = blocking_policy(boards, side, rng)
+  wins = winning_mask(boards, side)
+  has_win = wins.any(axis=1)
+  plays[has_win] = wins[has_win].argmax(axis=1)
+  return plays
+
+# Perfect play: a random square among the best ones in the solver table
+def perfect_policy(boards, side, rng):
+  best = _best_masks()[board_indices(boards)]
+  return random_choice((best[:, None] >> SQUARES) & 1 == 1, rng)
+
+# The best squares bitmask of the solver table as a numpy array
+_best = None
+def _best_masks():
+  global _best
+  if _best is None:
+    _best = np.array(get_table().best, dtype=np.int32)
+  return _best
+
+POLICIES = {
+  "random": random_policy,
+  "opportunist": opportunist_policy,
+  "blocking": blocking_policy,
+  "winblock": winblock_policy,
+  "perfect": perfect_policy,
+}
+
+# =====================================
+
+# Plays num_games games of policy_x (playing X) against policy_o at once
+# Returns the (num_games,) winners: +1 if X won, -1 if O won, 0 for a tie
+def play_games(policy_x, policy_o, num_games, rng):
+
+  boards = np.zeros((num_games, 9), dtype=np.int8)
+  winners = np.zeros(num_games, dtype=np.int8)
+  active = np.arange(num_games)
+  side = 1
+
+  for ply in range(9):
+    if len(active) == 0:
+      break
+    policy = policy_x if side == 1 else policy_o
+    plays = policy(boards[active], side, rng)
+    if (boards[active, plays] != 0).any():
+      raise RuntimeError("Illegal play!")
+    boards[active, plays] = side
+
+    # Only the side that just played can have won
+    sums = line_sums(boards[active])
+    won = (sums == 3*side).any(axis=1)
+    winners[active[won]] = side
+    active = active[~won]
+    side = -side
+
+  return winners
+
+# Evaluates the strength of policy against opponent (random by default) by
+# playing num_games games, each started by either at random
+# Games are played in batches of at most batch_size at once
+# Returns (strength, wins, ties, losses, elapsed) like trials.evaluate_player,
+# plus the strength measured after each number of games in xs if given
+def evaluate_policy(policy, num_games, opponent=random_policy, seed=None, xs=None, batch_size=100000):
+
+  start = datetime.datetime.now()
+  rng = np.random.default_rng(seed)
+
+  # Outcome of each game for the player: +1 win, 0 tie, -1 loss
+  outcomes = np.zeros(num_games, dtype=np.int8)
+  for first in range(0, num_games, batch_size):
+    last = min(first + batch_size, num_games)
+    starting = rng.random(last - first) > 0.5
+    num_starting = int(starting.sum())
+    outcomes[first:last][starting] = play_games(policy, opponent, num_starting, rng)
+    outcomes[first:last][~starting] = -play_games(opponent, policy, last - first - num_starting, rng)
+
+  wins = int((outcomes == 1).sum())
+  ties = int((outcomes == 0).sum())
+  losses = int((outcomes == -1).sum())
+  strength = (wins + ties/2) / num_games
+  elapsed = (datetime.datetime.now() - start).total_seconds()
+  results = (strength, wins, ties, losses, elapsed)
+  if xs is not None:
+    scores = np.cumsum(outcomes + 1) / 2
+    xs = np.asarray(xs)
+    results += ((scores[xs-1] / xs).tolist(),)
+
+  return results
+
+# ==============================================================================
+
+if __name__ == "__main__":
+
+  num_games = 1000000
+
+  for name, policy in POLICIES.items():
+    strength, wins, ties, losses, elapsed = evaluate_policy(policy, num_games)
+    print("{}: strength {:.5f}, {:,} games in {:.2f}s ({:,.0f} games/min)".format(
+      name, strength, num_games, elapsed, 60*num_games/elapsed))
@@ -0,0 +1,230 @@
+# Benchmarks of the hot paths of the engine, the players and the trainer
+# Times a fixed set of workloads, writes the results as JSON and optionally
+# compares them against a saved baseline to catch regressions
+# Usage: python benchmarks.py [--output results.json] [--baseline base.json]
+#   [--threshold 0.2] [--noise 1] [--min-time 1] [--quick]
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import platform
+import random
+import sys
+import time
+import numpy as np
+from tictactoe import GameState
+from players import RandomPlayer, OpportunistPlayer, BlockingPlayer, WinBlockPlayer, MinimaxPlayer, TablePlayer
+from NeuralNetwork import NeuralNetwork
+from NNPlayer import NNPlayer
+from trials import evaluate_player
+from SwarmTrainer import PSOTrainer
+
+# ==============================================================================
+
+# Minimum total time and number of runs of each workload
+MIN_TIME = 1.0
+MIN_TIME_QUICK = 0.25
+MIN_RUNS = 5
+
+# Runs func until it has run at least MIN_RUNS times and for at least
+# min_time seconds in total
+# Returns (median, spread): the median time in seconds of a run, and the
+# interquartile range of the times relative to the median, a measure of the
+# noise of the timing
+def measure(func, min_time):
+  times = []
+  total = 0.0
+  while len(times) < MIN_RUNS or total < min_time:
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    times.append(elapsed)
+    total += elapsed
+  q1, median, q3 = np.percentile(times, [25, 50, 75])
+  return median, (q3 - q1) / median
+
+# Returns the result of a workload that does n operations per run, as
+# (operations per second, unit, True, spread)
+def rate(func, n, unit, min_time):
+  median, spread = measure(func, min_time)
+  return (n/median, unit, True, spread)
+
+# Returns a list of random game states along random games
+def random_states(num_states, seed):
+  rng = random.Random(seed)
+  states = []
+  while len(states) < num_states:
+    state = GameState()
+    mark = "X"
+    while state.get_winner() is None and len(states) < num_states:
+      state = state.try_play_at(mark, rng.choice(state.get_legal_plays()))
+      states.append(state)
+      mark = "O" if mark == "X" else "X"
+  return states
+
+# Returns a 3-layer network with random weights and biases
+def random_network(seed):
+  np.random.seed(seed)
+  NN = NeuralNetwork(L=3, Ns=[9,9,9])
+  NN.randomize()
+  NN.params[:] -= 0.5
+  return NN
+
+# =====================================
+# The workloads
+# Each returns a dict of results: name -> (value, unit, higher_is_better,
+# spread), spread as returned by measure()
+
+# Engine microbenchmarks: winner checks and move application
+def bench_engine(min_time, quick):
+  states = random_states(1000, seed=0)
+  reps = 20 if quick else 200
+  results = {"engine.get_winner": rate(lambda: [state.get_winner() for _ in range(reps) for state in states],
+    reps*len(states), "calls/s", min_time)}
+  plays = []
+  for state in states:
+    legal_plays = state.get_legal_plays()
+    if legal_plays:
+      mark = "X" if state.plays % 2 == 0 else "O"
+      plays.append((state, mark, legal_plays[0]))
+  results["engine.try_play_at"] = rate(lambda: [state.try_play_at(mark, play) for _ in range(reps) for state, mark, play in plays],
+    reps*len(plays), "calls/s", min_time)
+  return results
+
+# Latency of the first move of MinimaxPlayer from the empty board, with a
+# cold cache (new player) and a warm one (same player again)
+def bench_minimax(min_time, quick):
+  results = {}
+  for search in ["minimax", "alphabeta"]:
+    def cold():
+      player = MinimaxPlayer(mark="X", search=search)
+      player.get_play(GameState())
+    player = MinimaxPlayer(mark="X", search=search)
+    player.get_play(GameState())
+    warm = lambda: player.get_play(GameState())
+    median, spread = measure(cold, min_time)
+    results["minimax.%s.first_move_cold" % search] = (1000*median, "ms", False, spread)
+    median, spread = measure(warm, min_time)
+    results["minimax.%s.first_move_warm" % search] = (1000*median, "ms", False, spread)
+  return results
+
+# Throughput of the network evaluation, one input at a time and batched
+def bench_network(min_time, quick):
+  NN = random_network(seed=0)
+  X = np.random.default_rng(0).integers(-1, 2, size=(10000, 9)).astype(float)
+  n = 1000 if quick else 10000
+  results = {"network.evaluate": rate(lambda: [NN.evaluate(X[i]) for i in range(n)], n, "evals/s", min_time)}
+  results["network.evaluate_batch"] = rate(lambda: NN.evaluate_batch(X), len(X), "evals/s", min_time)
+  return results
+
+# Games per second of evaluate_player for each player against RandomPlayer
+def bench_games(min_time, quick):
+  players = [
+    RandomPlayer(quiet=True),
+    OpportunistPlayer(quiet=True),
+    BlockingPlayer(quiet=True),
+    WinBlockPlayer(quiet=True),
+    MinimaxPlayer(),
+    TablePlayer(),
+    NNPlayer(NN=random_network(seed=0)),
+  ]
+  num_games = 200 if quick else 2000
+  results = {}
+  for player in players:
+    results["games.%s_vs_Random" % player.name] = rate(lambda: evaluate_player(player, num_games, seed=0),
+      num_games, "games/s", min_time)
+  return results
+
+# Duration of one PSOTrainer step (velocity update, move and fitness)
+def bench_pso(min_time, quick):
+  trainer = PSOTrainer(num_steps=0, num_parts=10, num_games=50 if quick else 200, seed=0, checkpoint_every=0, fitness_cache_size=0)
+  with contextlib.redirect_stdout(io.StringIO()):
+    trainer.train()
+  def step():
+    trainer.swarm.update_vel()
+    trainer.swarm.move()
+    trainer.eval_all_fitness(1)
+    trainer.swarm.update_best_pos()
+  median, spread = measure(step, min_time)
+  return {"pso.step": (median, "s", False, spread)}
+
+BENCHMARKS = [bench_engine, bench_minimax, bench_network, bench_games, bench_pso]
+
+# =====================================
+
+# Runs all benchmarks and returns the JSON-serializable report
+# Each workload is repeated for at least min_time seconds (MIN_TIME, or
+# MIN_TIME_QUICK if quick, by default)
+def run_benchmarks(quick=False, report=True, min_time=None):
+  if min_time is None:
+    min_time = MIN_TIME_QUICK if quick else MIN_TIME
+  results = {}
+  for bench in BENCHMARKS:
+    for name, (value, unit, higher_is_better, spread) in bench(min_time, quick).items():
+      results[name] = {"value": value, "unit": unit, "higher_is_better": higher_is_better, "spread": spread}
+      if report: print("%-45s %14.3f %-8s +-%.1f%%" % (name, value, unit, 100*spread))
+  return {
+    "timestamp": datetime.datetime.now().isoformat(),
+    "python": platform.python_version(),
+    "numpy": np.__version__,
+    "machine": platform.machine(),
+    "quick": quick,
+    "results": results,
+  }
+
+# Compares results against a baseline report
+# The noise of a comparison is noise_factor times the sum of the spreads of
+# the two measurements
+# Returns the list of (name, baseline value, value, relative change) of the
+# benchmarks that got worse by more than both threshold (a fraction) and
+# their noise
+def compare(results, baseline, threshold, noise_factor=1.0, report=True):
+  regressions = []
+  for name, result in results["results"].items():
+    if name not in baseline["results"]:
+      continue
+    base = baseline["results"][name]["value"]
+    value = result["value"]
+    if result["higher_is_better"]:
+      change = value/base - 1
+    else:
+      change = base/value - 1
+    noise = noise_factor * (result.get("spread", 0) + baseline["results"][name].get("spread", 0))
+    if report: print("%-45s %+7.1f%%  (noise %.1f%%)" % (name, 100*change, 100*noise))
+    if change < -threshold and -change > noise:
+      regressions.append((name, base, value, change))
+  return regressions
+
+# ==============================================================================
+
+if __name__ == "__main__":
+
+  parser = argparse.ArgumentParser(description="Benchmarks of the engine, players and trainer")
+  parser.add_argument("--output", help="write the results to this JSON file")
+  parser.add_argument("--baseline", help="compare against this JSON file of results")
+  parser.add_argument("--threshold", type=float, default=0.2, help="relative slowdown reported as a regression")
+  parser.add_argument("--noise", type=float, default=1.0, help="multiple of the measured spreads a slowdown must exceed to be a regression")
+  parser.add_argument("--min-time", type=float, help="minimum time in seconds each workload is repeated for")
+  parser.add_argument("--quick", action="store_true", help="run smaller workloads")
+  args = parser.parse_args()
+
+  results = run_benchmarks(quick=args.quick, min_time=args.min_time)
+
+  if args.output is not None:
+    f = open(args.output, "w")
+    json.dump(results, f, indent=2)
+    f.close()
+    print("Wrote %s" % args.output)
+
+  if args.baseline is not None:
+    f = open(args.baseline)
+    baseline = json.load(f)
+    f.close()
+    print("\nChange vs. %s:" % args.baseline)
+    regressions = compare(results, baseline, args.threshold, args.noise)
+    if len(regressions) > 0:
+      print("\n%i regression(s) beyond %.0f%% and the noise:" % (len(regressions), 100*args.threshold))
+      for name, base, value, change in regressions:
+        print("  %s: %.4g -> %.4g (%+.1f%%)" % (name, base, value, 100*change))
+      sys.exit(1)
@@ -0,0 +1,87 @@
+# Low-level bitboard primitives for the 3x3 game
+# A board is described by two 9-bit integers, one per mark, where bit
+# k = 3*i + j is set if that mark occupies square (i,j)
+# Everything here is precomputed once at import time so that the game
+# engine only has to do table lookups and bit operations
+
+# ==============================================================================
+
+# Bitmask of the whole board
+FULL = 0x1FF
+
+# Bit for each square, indexed by k = 3*i + j
+SQUARE_BITS = [1 << k for k in range(9)]
+
+# The (i,j) position of each square index
+POSITIONS = [(k // 3, k % 3) for k in range(9)]
+
+# The 8 winning lines as bitmasks (3 rows, 3 columns, 2 diagonals)
+WIN_MASKS = [
+  0b000000111, 0b000111000, 0b111000000,
+  0b001001001, 0b010010010, 0b100100100,
+  0b100010001, 0b001010100,
+]
+
+# WINNING[bits] is True if the 9-bit pattern contains a full line
+WINNING = [any(bits & m == m for m in WIN_MASKS) for bits in range(512)]
+
+# POPCOUNT[bits] is the number of set bits of a 9-bit pattern
+POPCOUNT = [bin(bits).count("1") for bits in range(512)]
+
+# LEGAL_PLAYS[occupied] is the tuple of (i,j) positions not in occupied
+LEGAL_PLAYS = [tuple(POSITIONS[k] for k in range(9) if not occupied >> k & 1)
+  for occupied in range(512)]
+
+# COMPLETIONS[bits] is the bitmask of the squares that would complete a line
+# for a mark occupying the 9-bit pattern bits; those of them that are empty
+# are the mark's winning plays: COMPLETIONS[mine] & ~occupied
+COMPLETIONS = [0] * 512
+for bits in range(512):
+  for m in WIN_MASKS:
+    if POPCOUNT[bits & m] == 2:
+      COMPLETIONS[bits] |= m & ~bits
+
+# SQUARE_PLAYS[bits] is the tuple of (i,j) positions of the squares in bits
+SQUARE_PLAYS = [tuple(POSITIONS[k] for k in range(9) if bits >> k & 1)
+  for bits in range(512)]
+
+# Returns the bitboards (xbits, obits) of a 3x3 game state, from its key():
+# works for GameState and for any state whose key is the X bitboard shifted
+# over the O bitboard, like a 3,3,3 MNKState
+def state_bits(state):
+  if state.geometry != (3, 3, 3):
+    raise RuntimeError("Only 3x3 games are supported, not %i,%i,%i" % tuple(state.geometry))
+  key = state.key()
+  return key >> 9, key & FULL
+
+# =====================================
+# Board symmetries
+
+# The 8 symmetries of the square (the dihedral group D4) as permutations of
+# square indices: TRANSFORMS[t][k] is where square k goes under transform t
+# t = 0 is the identity, 1-3 are rotations, 4-7 are reflections
+def _transform_square(t, k):
+  i, j = k // 3, k % 3
+  for _ in range(t % 4):
+    i, j = j, 2 - i
+  if t >= 4:
+    j = 2 - j
+  return 3*i + j
+
+TRANSFORMS = [[_transform_square(t, k) for k in range(9)] for t in range(8)]
+
+# TRANSFORM_BITS[t][bits] is the 9-bit pattern transformed by t
+TRANSFORM_BITS = [[sum(1 << perm[k] for k in range(9) if bits >> k & 1)
+  for bits in range(512)] for perm in TRANSFORMS]
+
+# Returns (xbits, obits, t): the canonical representative of the board under
+# the 8 symmetries, and the transform t that maps the board onto it
+def canonical(xbits, obits):
+  best = None
+  for t in range(8):
+    table = TRANSFORM_BITS[t]
+    key = (table[xbits] << 9) | table[obits]
+    if best is None or key < best:
+      best = key
+      best_t = t
+  return best >> 9, best & FULL, best_t
@@ -0,0 +1,131 @@
+# Opt-in instrumentation of games, players and searches
+# A Stats object collects move latency histograms per player, named counters
+# (nodes searched, cache hits...) and the time spent in games, and can be
+# merged with the Stats of other processes
+# Everything that accepts a stats argument does nothing extra when it's None
+import math
+
+# ==============================================================================
+
+# Histogram of durations in power-of-two buckets of microseconds: bucket b
+# holds durations in [2^(b-1), 2^b) us, bucket 0 those under 1 us
+class Histogram:
+
+  def __init__(self):
+    self.buckets = {}
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+
+  # Adds a duration in seconds
+  def add(self, seconds):
+    b = int(seconds * 1e6).bit_length()
+    self.buckets[b] = self.buckets.get(b, 0) + 1
+    self.count += 1
+    self.total += seconds
+    if seconds > self.max:
+      self.max = seconds
+
+  # Adds the contents of another histogram
+  def merge(self, other):
+    for b, n in other.buckets.items():
+      self.buckets[b] = self.buckets.get(b, 0) + n
+    self.count += other.count
+    self.total += other.total
+    self.max = max(self.max, other.max)
+
+  # Returns the mean duration in seconds
+  def mean(self):
+    return self.total / self.count if self.count > 0 else 0.0
+
+  # Returns an upper bound (the bucket edge) of the q-th quantile, in seconds
+  def quantile(self, q):
+    target = math.ceil(q * self.count)
+    seen = 0
+    for b in sorted(self.buckets):
+      seen += self.buckets[b]
+      if seen >= target:
+        return 2**b / 1e6
+    return 0.0
+
+# =====================================
+
+# The measurements of a run: games played and their total duration, a move
+# latency Histogram per player name, counters and timers by name
+class Stats:
+
+  def __init__(self):
+    self.games = 0
+    self.game_time = 0.0
+    self.moves = {}
+    self.counters = {}
+    self.timers = {}
+
+  # Records num_games finished games that took the given number of seconds
+  def record_games(self, num_games, seconds):
+    self.games += num_games
+    self.game_time += seconds
+
+  # Records a move by the named player that took the given number of seconds
+  def record_move(self, name, seconds):
+    if name not in self.moves:
+      self.moves[name] = Histogram()
+    self.moves[name].add(seconds)
+
+  # Adds n to the named counter
+  def count(self, name, n=1):
+    self.counters[name] = self.counters.get(name, 0) + n
+
+  # Adds seconds to the named timer (e.g. a phase of a training step)
+  def record_time(self, name, seconds):
+    self.timers[name] = self.timers.get(name, 0.0) + seconds
+
+  # Total time spent inside the players' get_play
+  def agent_time(self):
+    return sum(hist.total for hist in self.moves.values())
+
+  # Time spent in games outside the players: the game engine itself
+  def engine_time(self):
+    return self.game_time - self.agent_time()
+
+  # Adds the contents of another Stats (e.g. from a worker process)
+  def merge(self, other):
+    self.games += other.games
+    self.game_time += other.game_time
+    for name, hist in other.moves.items():
+      if name not in self.moves:
+        self.moves[name] = Histogram()
+      self.moves[name].merge(hist)
+    for name, n in other.counters.items():
+      self.count(name, n)
+    for name, seconds in other.timers.items():
+      self.record_time(name, seconds)
+
+  # Returns a text report of everything collected
+  def summary(self):
+    lines = []
+    if self.games > 0:
+      lines.append("Games: {:,} in {:.3f}s ({:,.0f} games/s)".format(
+        self.games, self.game_time, self.games / self.game_time if self.game_time > 0 else 0))
+      if self.game_time > 0 and len(self.moves) > 0:
+        agent = self.agent_time()
+        lines.append("Time in agents: %.3fs (%.1f%%), in engine: %.3fs (%.1f%%)" % (
+          agent, 100*agent/self.game_time, self.engine_time(), 100*self.engine_time()/self.game_time))
+    for name in sorted(self.moves):
+      hist = self.moves[name]
+      lines.append("%s: %i moves, mean %.1fus, p50 <%.0fus, p99 <%.0fus, max %.1fus" % (
+        name, hist.count, 1e6*hist.mean(), 1e6*hist.quantile(0.5), 1e6*hist.quantile(0.99), 1e6*hist.max))
+      for b in sorted(hist.buckets):
+        low = 0 if b == 0 else 2**(b-1)
+        lines.append("  [%7i, %7i) us: %i" % (low, 2**b, hist.buckets[b]))
+    for name in sorted(self.timers):
+      lines.append("%s: %.3fs" % (name, self.timers[name]))
+    for name in sorted(self.counters):
+      lines.append("%s: %i" % (name, self.counters[name]))
+    for name, n in self.counters.items():
+      if name.endswith(".cache_hits"):
+        prefix = name[:-len(".cache_hits")]
+        misses = self.counters.get(prefix + ".cache_misses", 0)
+        if n + misses > 0:
+          lines.append("%s cache hit rate: %.1f%%" % (prefix, 100*n/(n + misses)))
+    return "\n".join(lines)
@@ -0,0 +1,295 @@
+# The m,n,k-game: tic-tac-toe on an m x n board where k marks in a row win
+# (tic-tac-toe is the 3,3,3-game, Gomoku the 15,15,5-game)
+# MNKState has the interface of tictactoe.GameState, so the players and
+# TicTacToe work on it, and adds undo() for searches that play and unplay
+# moves on a single state instead of copying it
+import random
+import time
+
+# ==============================================================================
+
+# The 4 line directions (row step, column step): horizontal, vertical and the
+# two diagonals
+DIRECTIONS = [(0, 1), (1, 0), (1, 1), (1, -1)]
+
+# Tables of the squares around each square of an m x n board, built once per
+# geometry
+# RAYS[s] holds, for each direction, the two lists of squares leaving square
+# s = n*i + j in opposite senses (up to k-1 squares each), so that the lines
+# through s can be checked without looking at the rest of the board
+_rays = {}
+
+def get_rays(m, n, k):
+  if (m, n, k) not in _rays:
+    rays = []
+    for i in range(m):
+      for j in range(n):
+        square_rays = []
+        for di, dj in DIRECTIONS:
+          pair = []
+          for sense in (1, -1):
+            ray = []
+            for step in range(1, k):
+              ii = i + sense*step*di
+              jj = j + sense*step*dj
+              if not (0 <= ii < m and 0 <= jj < n):
+                break
+              ray.append(n*ii + jj)
+            pair.append(ray)
+          square_rays.append(tuple(pair))
+        rays.append(square_rays)
+    _rays[(m, n, k)] = rays
+  return _rays[(m, n, k)]
+
+# =====================================
+
+# The state of an m,n,k-game
+# The board is a flat list of "X", "O" or None indexed by s = n*i + j
+# The empty squares are kept in a list (with the index of each square in it)
+# so that a play or its undo remove or put back a square in O(1)
+# The winner is updated after every play by checking only the lines through
+# the square just played
+class MNKState:
+
+  # Creates a new game on an m x n board with k in a row to win
+  # grid (a list of m lists of n "X", "O" or None) is an optional position
+  def __init__(self, m=3, n=3, k=3, grid=None):
+    if m < 1 or n < 1 or k < 1:
+      raise RuntimeError("Invalid geometry: %i,%i,%i" % (m, n, k))
+    self.m = m
+    self.n = n
+    self.k = k
+    self.geometry = (m, n, k)
+    self.num_squares = m*n
+    self.rays = get_rays(m, n, k)
+    self.reset()
+    if grid is not None:
+      self.grid = grid
+
+  # Empties the board
+  def reset(self):
+    self.board = [None] * self.num_squares
+    self.xmask = 0
+    self.omask = 0
+    self.free = list(range(self.num_squares))
+    self.where = list(range(self.num_squares))
+    self.history = []
+    self.plays = 0
+    self.winner = None
+
+  # The grid as a list of m lists of n "X", "O" or None
+  # This is a fresh copy: modifying it does not change the state
+  @property
+  def grid(self):
+    n = self.n
+    return [self.board[n*i:n*i+n] for i in range(self.m)]
+
+  # Loads the state from a list of m lists of n "X", "O" or None
+  # The loaded plays can't be undone
+  @grid.setter
+  def grid(self, grid):
+    self.reset()
+    for i in range(self.m):
+      for j in range(self.n):
+        if grid[i][j] in ("X", "O"):
+          self.play_at(grid[i][j], (i,j))
+        elif grid[i][j] is not None:
+          raise RuntimeError("Illegal symbol found in grid!")
+    # Plays were loaded in board order, so the winner must be found anew
+    winners = set()
+    for s in range(self.num_squares):
+      if self.board[s] is not None and self.completes(s, self.board[s]):
+        winners.add(self.board[s])
+    if len(winners) > 1:
+      raise RuntimeError("Illegal board with 2 winners!")
+    if len(winners) == 1:
+      self.winner = winners.pop()
+    elif self.plays == self.num_squares:
+      self.winner = "tie"
+    else:
+      self.winner = None
+    self.history = []
+
+  # Returns whether mark at square s is part of k in a row
+  def completes(self, s, mark):
+    board = self.board
+    for forward, backward in self.rays[s]:
+      count = 1
+      for t in forward:
+        if board[t] != mark:
+          break
+        count += 1
+      for t in backward:
+        if board[t] != mark:
+          break
+        count += 1
+      if count >= self.k:
+        return True
+    return False
+
+  # Plays for player ("X" or "O") at pos (i,j)
+  def play_at(self, player, pos):
+    i,j = pos
+    if not (0 <= i < self.m and 0 <= j < self.n):
+      raise RuntimeError("Illegal play!")
+    s = self.n*i + j
+    if self.board[s] is not None:
+      raise RuntimeError("Illegal play!")
+    if player == "X":
+      self.xmask |= 1 << s
+    elif player == "O":
+      self.omask |= 1 << s
+    else:
+      raise RuntimeError("Invalid player: %s" % str(player))
+    self.board[s] = player
+
+    # Remove the square from the free list, moving the last one in its place
+    free = self.free
+    p = self.where[s]
+    last = free.pop()
+    if last != s:
+      free[p] = last
+      self.where[last] = p
+
+    self.history.append((s, p, self.winner))
+    self.plays += 1
+    if self.winner is None:
+      if self.completes(s, player):
+        self.winner = player
+      elif self.plays == self.num_squares:
+        self.winner = "tie"
+
+  # Takes back the last play
+  def undo(self):
+    if len(self.history) == 0:
+      raise RuntimeError("No plays to undo!")
+    s, p, winner = self.history.pop()
+    if self.board[s] == "X":
+      self.xmask &= ~(1 << s)
+    else:
+      self.omask &= ~(1 << s)
+    self.board[s] = None
+
+    # Put the square back where it was in the free list
+    free = self.free
+    if p == len(free):
+      free.append(s)
+    else:
+      moved = free[p]
+      free.append(moved)
+      self.where[moved] = len(free) - 1
+      free[p] = s
+    self.where[s] = p
+
+    self.plays -= 1
+    self.winner = winner
+
+  # Returns the gamestate that results from player playing at pos
+  def try_play_at(self, player, pos):
+    newstate = self.copy()
+    newstate.play_at(player, pos)
+    return newstate
+
+  # Returns a hashable key that identifies the position (of a given
+  # geometry)
+  def key(self):
+    return (self.xmask << self.num_squares) | self.omask
+
+  # Returns an independent copy of the state
+  def copy(self):
+    newstate = MNKState.__new__(MNKState)
+    newstate.__dict__.update(self.__dict__)
+    newstate.board = self.board[:]
+    newstate.free = self.free[:]
+    newstate.where = self.where[:]
+    newstate.history = self.history[:]
+    return newstate
+
+  # Returns the list of (i,j) squares of legal plays (i.e. unplayed squares)
+  # They aren't in any particular order
+  def get_legal_plays(self):
+    n = self.n
+    return [(s // n, s % n) for s in self.free]
+
+  # Returns a random legal play (for fast playouts)
+  def random_play(self):
+    s = random.choice(self.free)
+    return (s // self.n, s % self.n)
+
+  # Returns the list of (i,j) squares where player ("X" or "O") would
+  # complete k in a row, in board order
+  def winning_plays(self, player):
+    if player != "X" and player != "O":
+      raise RuntimeError("Invalid player: %s" % str(player))
+    n = self.n
+    return [(s // n, s % n) for s in sorted(self.free) if self.completes(s, player)]
+
+  # Counts the number of played squares
+  def count_plays(self):
+    return self.plays
+
+  # Returns whether the grid has no played squares
+  def is_empty(self):
+    return self.plays == 0
+
+  # Returns whether the grid has no unplayed squares left
+  def is_full(self):
+    return self.plays == self.num_squares
+
+  # Returns whether the game state is a winning position (k in line)
+  # A full board (a tie) counts as well, i.e. this is whether the game is over
+  def is_winning(self):
+    return self.winner is not None
+
+  # Returns the winner of the game state: "X", "O", "tie", or None if the
+  # game isn't over
+  def get_winner(self):
+    return self.winner
+
+  # ASCII representation of the game state
+  def show(self):
+    grid = self.grid
+    for i in range(self.m):
+      s = ""
+      for j in range(self.n):
+        s += " "
+        if grid[i][j] is None:
+          symb = " "
+        else:
+          symb = grid[i][j]
+        s += symb
+        if j != self.n-1:
+          s += " |"
+      print(s)
+      if i != self.m-1:
+        print("-" * (4*self.n - 1))
+
+# ==============================================================================
+
+if __name__ == "__main__":
+
+  from tictactoe import TicTacToe
+  from players import OpportunistPlayer, BlockingPlayer
+
+  # Random games on bigger boards, playing and undoing on a single state
+  for m, n, k in [(7, 7, 4), (15, 15, 5)]:
+    state = MNKState(m, n, k)
+    num_games = 1000
+    wins = {"X": 0, "O": 0, "tie": 0}
+    start = time.perf_counter()
+    for _ in range(num_games):
+      mark = "X"
+      while state.get_winner() is None:
+        state.play_at(mark, random.choice(state.get_legal_plays()))
+        mark = "O" if mark == "X" else "X"
+      wins[state.get_winner()] += 1
+      while state.plays > 0:
+        state.undo()
+    elapsed = time.perf_counter() - start
+    print("%i,%i,%i: %i random games in %.2fs, %s" % (m, n, k, num_games, elapsed, wins))
+
+  # The usual players on a 7,7,4 board
+  game = TicTacToe(OpportunistPlayer(quiet=True), BlockingPlayer(quiet=True), quiet=True, state=MNKState(7, 7, 4))
+  winner = game.play()
+  game.gamestate.show()
+  print("Winner:", winner)
@@ -1,4 +1,8 @@
+import math
 import random
+import time
+from bitboard import canonical, state_bits
+from solver import get_table
 # ==============================================================================
 # Player agents for tic-tac-toe
 
@@ -7,6 +11,89 @@ import random
 # self.mark: stores the assigned playing mark
 # self.get_play(self, state): receives a gamestate and returns the move to play
 # Might use ABCs in the future
+# Players whose plays are random can also implement
+# self.get_play_distribution(self, state): returns a list of (play, probability)
+# with the probability of get_play returning each play, so that they can be
+# evaluated exactly (see trials.py)
+# Players whose plays are random but that can't list their probabilities
+# must set self.deterministic = False, so that they're not evaluated exactly
+
+# Bound types of the alpha-beta cache entries
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+INFINITY = float("inf")
+
+# Order in which MinimaxPlayer tries otherwise equal plays: center, corners,
+# then edges
+SQUARE_PRIORITY = {
+  (1,1): 0,
+  (0,0): 1, (0,2): 1, (2,0): 1, (2,2): 1,
+  (0,1): 2, (1,0): 2, (1,2): 2, (2,1): 2,
+}
+
+# Raised inside a search of MinimaxPlayer when its time is up
+class SearchTimeout(Exception):
+  pass
+
+# Bitmasks of all the lines of k squares of an m x n board (square
+# s = n*i + j), built once per geometry
+_line_masks = {}
+
+def get_line_masks(geometry):
+  if geometry not in _line_masks:
+    m, n, k = geometry
+    masks = []
+    for i in range(m):
+      for j in range(n):
+        for di, dj in [(0, 1), (1, 0), (1, 1), (1, -1)]:
+          if 0 <= i + (k-1)*di < m and 0 <= j + (k-1)*dj < n:
+            masks.append(sum(1 << (n*(i + t*di) + j + t*dj) for t in range(k)))
+    _line_masks[geometry] = masks
+  return _line_masks[geometry]
+
+# The line masks through each square s of a board, built once per geometry
+_square_lines = {}
+
+def get_square_lines(geometry):
+  if geometry not in _square_lines:
+    m, n, k = geometry
+    masks = get_line_masks(geometry)
+    _square_lines[geometry] = [[line for line in masks if line >> s & 1] for s in range(m*n)]
+  return _square_lines[geometry]
+
+# Default evaluation of the positions where MinimaxPlayer's depth-limited
+# search stops: the balance between the lines still open for mark and for
+# its opponent, each weighted by 3 to the number of marks already on it
+# Lines without marks are open for both sides alike, so they don't count
+# and the empty board scores 0 for either mark
+# Works on any state whose key() is the X bitboard shifted over the O
+# bitboard, like GameState's and MNKState's
+# Returns a value in (-1, 1), from the point of view of mark
+def line_heuristic(state, mark):
+  N = state.num_squares
+  key = state.key()
+  xbits = key >> N
+  obits = key & ((1 << N) - 1)
+  # Only the lines through the played squares need to be looked at
+  square_lines = get_square_lines(state.geometry)
+  touched = set()
+  occupied = xbits | obits
+  while occupied:
+    low = occupied & -occupied
+    touched.update(square_lines[low.bit_length() - 1])
+    occupied ^= low
+  xscore = 0
+  oscore = 0
+  for line in touched:
+    if line & obits == 0:
+      xscore += 3**bin(line & xbits).count("1")
+    elif line & xbits == 0:
+      oscore += 3**bin(line & obits).count("1")
+  if mark == "O":
+    xscore, oscore = oscore, xscore
+  return (xscore - oscore) / (xscore + oscore + 1)
 
 # =====================================
 
@@ -28,6 +115,11 @@ class RandomPlayer():
         print("RandomPlayer says: I have no idea what I'm doing.")
     return random.choice(legal_plays)
 
+  # Returns the list of (play, probability) of the plays get_play may return
+  def get_play_distribution(self, state):
+    legal_plays = state.get_legal_plays()
+    return [(play, 1/len(legal_plays)) for play in legal_plays]
+
 # =====================================
 
 # Plays a winning move if it can, randomly otherwise
@@ -44,14 +136,21 @@ class OpportunistPlayer():
     legal_plays = state.get_legal_plays()
     if len(legal_plays) == 0:
       raise RuntimeError("No legal plays possible!")
-    for play in legal_plays:
-      newstate = state.try_play_at(self.mark, play)
-      if newstate.get_winner() == self.mark:
-        if not self.quiet:
-          print("OpportunistPlayer says: Hah, you're toast!")
-        return play
+    wins = state.winning_plays(self.mark)
+    if len(wins) > 0:
+      if not self.quiet:
+        print("OpportunistPlayer says: Hah, you're toast!")
+      return wins[0]
     return random.choice(legal_plays)
 
+  # Returns the list of (play, probability) of the plays get_play may return
+  def get_play_distribution(self, state):
+    wins = state.winning_plays(self.mark)
+    if len(wins) > 0:
+      return [(wins[0], 1.0)]
+    legal_plays = state.get_legal_plays()
+    return [(play, 1/len(legal_plays)) for play in legal_plays]
+
 # =====================================
 
 # If the opponent is about to win, blocks (one of) the winning move; plays
@@ -68,15 +167,60 @@ class BlockingPlayer():
     legal_plays = state.get_legal_plays()
     if len(legal_plays) == 0:
       raise RuntimeError("No legal plays possible!")
-    for pos in legal_plays:
-      opponent = "O" if self.mark == "X" else "X"
-      newstate = state.try_play_at(opponent, pos)
-      if newstate.get_winner() == opponent:
-        if not self.quiet:
-          print("BlockingPlayer says: You thought I wouldn't see that, didn't you.")
-        return pos
+    opponent = "O" if self.mark == "X" else "X"
+    blocks = state.winning_plays(opponent)
+    if len(blocks) > 0:
+      if not self.quiet:
+        print("BlockingPlayer says: You thought I wouldn't see that, didn't you.")
+      return blocks[0]
     return random.choice(legal_plays)
 
+  # Returns the list of (play, probability) of the plays get_play may return
+  def get_play_distribution(self, state):
+    opponent = "O" if self.mark == "X" else "X"
+    blocks = state.winning_plays(opponent)
+    if len(blocks) > 0:
+      return [(blocks[0], 1.0)]
+    legal_plays = state.get_legal_plays()
+    return [(play, 1/len(legal_plays)) for play in legal_plays]
+
+# =====================================
+
+# Plays a winning move if it can; otherwise blocks the opponent's winning
+# move if there is one, and plays randomly if not
+class WinBlockPlayer():
+
+  def __init__(self, mark=None, quiet=False):
+    self.name = "WinBlockPlayer"
+    self.mark = mark
+    self.quiet = quiet
+
+  # Receives a GameState and returns the position to play
+  def get_play(self, state):
+    legal_plays = state.get_legal_plays()
+    if len(legal_plays) == 0:
+      raise RuntimeError("No legal plays possible!")
+    wins = state.winning_plays(self.mark)
+    if len(wins) > 0:
+      return wins[0]
+    opponent = "O" if self.mark == "X" else "X"
+    blocks = state.winning_plays(opponent)
+    if len(blocks) > 0:
+      return blocks[0]
+    return random.choice(legal_plays)
+
+  # Returns the list of (play, probability) of the plays get_play may return
+  def get_play_distribution(self, state):
+    wins = state.winning_plays(self.mark)
+    if len(wins) > 0:
+      return [(wins[0], 1.0)]
+    opponent = "O" if self.mark == "X" else "X"
+    blocks = state.winning_plays(opponent)
+    if len(blocks) > 0:
+      return [(blocks[0], 1.0)]
+    legal_plays = state.get_legal_plays()
+    return [(play, 1/len(legal_plays)) for play in legal_plays]
+
 # =====================================
 
 # A "player" that asks the human what to do in the prompt
@@ -85,6 +229,7 @@ class HumanPlayer():
   def __init__(self, mark=None):
     self.name = "Human"
     self.mark = mark
+    self.deterministic = False
 
   # Receives a GameState and returns the position to play
   # Human must enter comma-separated row and column. (0,0) is upper left.
@@ -101,7 +246,7 @@ class HumanPlayer():
         i,j = ans.split(",")
         i = int(i)
         j = int(j)
-        if i in [0,1,2] and j in [0,1,2] and (i,j) in legal_plays:
+        if (i,j) in legal_plays:
           accept = True
       except:
         continue
@@ -111,27 +256,48 @@ class HumanPlayer():
 
 # A Minimax AI player
 # Uses a game cache to greatly speed up score estimation
+# With symmetry=True the 8 rotations and reflections of a position share a
+# single cache entry, since they all have the same score
+# search selects the algorithm: "minimax" expands every play at every node,
+# "alphabeta" prunes plays that can't change the result, trying the most
+# promising ones first, and caches score bounds as well as exact scores
+# "iterative" searches with alpha-beta to depth 1, 2, 3... until the game
+# is solved, max_depth is reached or time_limit_ms runs out, and plays the
+# best play of the deepest completed iteration; positions at the depth limit
+# are scored by heuristic(state, mark), a value in (-1, 1) from the point of
+# view of mark (line_heuristic by default), so that any win or loss counts
+# more; with symmetry=True the heuristic must be symmetric too
+# cache is an optional transposition.TranspositionCache to use instead of a
+# cache of its own, e.g. one shared with other players or saved to disk
+# Works on any state with the GameState interface (e.g. mnk.MNKState), but
+# only small boards can be searched to the end
+# stats is an optional instrument.Stats to which every search adds its
+# number of nodes and cache hits and misses
 class MinimaxPlayer:
 
-  def __init__(self, mark=None, debug=False):
+  def __init__(self, mark=None, debug=False, symmetry=True, search="minimax", stats=None, time_limit_ms=None, max_depth=None, heuristic=None, cache=None):
     self.name = "MinimaxPlayer"
     self.mark = mark
     self.debug = debug
-    self.cache = {}
+    self.symmetry = symmetry
+    if search not in ["minimax", "alphabeta", "iterative"]:
+      raise RuntimeError("Invalid search: %s" % str(search))
+    self.search = search
+    self.time_limit_ms = time_limit_ms
+    self.max_depth = max_depth
+    if heuristic is None:
+      heuristic = line_heuristic
+    self.heuristic = heuristic
+    self.shared_cache = cache is not None
+    self.cache = cache if cache is not None else {}
+    self.geometry = None
+    self.stats = stats
 
   # Receives a GameState and returns the position to play
   def get_play(self, state):
 
-    legal_plays = state.get_legal_plays()
-    if len(legal_plays) == 0:
-      raise RuntimeError("No legal plays possible!")
-    self.opp_mark = "O" if self.mark == "X" else "X"
-
     # Obtain expected scores for all plays
-    self.explored = 0
-    if self.debug: print("Size of game cache:", len(self.cache))
-    play_scores = self.minimax(self.mark, state, 0)
-    if self.debug: print("Explored positions:", self.explored)
+    play_scores = self.score_plays(state)
 
     # Rank plays by score
     play_scores.sort(key=lambda x: x[1], reverse=True)
@@ -139,17 +305,19 @@ class MinimaxPlayer:
     # Determine game result and depth for each play
     if self.debug:
       print("Game analysis:")
+    # (heuristic scores of the iterative search, between -1 and 1, are
+    # counted as ties)
     for i in range(len(play_scores)):
       play, score = play_scores[i]
-      if score > 0:
+      if score >= 1:
         result = +1
-        depth = 10 - score
-      elif score == 0:
-        result = 0
-        depth = 9
-      elif score < 0:
+        depth = self.win_score - score
+      elif score <= -1:
         result = -1
-        depth = 10 + score
+        depth = self.win_score + score
+      else:
+        result = 0
+        depth = state.num_squares
       play_scores[i] = play_scores[i] + (result, depth)
       if self.debug: print(play, score, depth)
 
@@ -169,21 +337,61 @@ class MinimaxPlayer:
 
     return best_play
 
+  # Returns the list of (play, probability) of the plays get_play may return
+  def get_play_distribution(self, state):
+    play_scores = self.score_plays(state)
+    best_score = max(score for play, score in play_scores)
+    best_plays = [play for play, score in play_scores if score == best_score]
+    return [(play, 1/len(best_plays)) for play in best_plays]
+
+  # Returns the list of (play, score) for all the agent's legal plays
+  def score_plays(self, state):
+    legal_plays = state.get_legal_plays()
+    if len(legal_plays) == 0:
+      raise RuntimeError("No legal plays possible!")
+    self.opp_mark = "O" if self.mark == "X" else "X"
+    # Cached scores are only valid for one board size (and a shared cache
+    # for one kind of search)
+    if state.geometry != self.geometry:
+      if self.shared_cache:
+        self.cache.bind(self.search, state.geometry, self.heuristic if self.search == "iterative" else None)
+      else:
+        self.cache = {}
+      self.geometry = state.geometry
+      self.num_squares = state.num_squares
+      self.win_score = state.num_squares + 1
+    self.explored = 0
+    self.cache_hits = 0
+    if self.debug: print("Size of game cache:", len(self.cache))
+    if self.search == "alphabeta":
+      play_scores = self.alphabeta_root(state)
+    elif self.search == "iterative":
+      play_scores = self.iterative_root(state)
+    else:
+      play_scores = self.minimax(self.mark, state, 0)
+    if self.debug: print("Explored positions:", self.explored)
+    if self.debug: print("Cache hits:", self.cache_hits)
+    if self.stats is not None:
+      # Every explored node was a cache miss
+      self.stats.count(self.name + ".nodes", self.explored)
+      self.stats.count(self.name + ".cache_hits", self.cache_hits)
+      self.stats.count(self.name + ".cache_misses", self.explored)
+    return play_scores
+
   # Serializes a game state (including the player to move) so it can
   # be hashed and cached
+  # The key is an integer: one bit for whether the agent is to move, then
+  # the two bitboards, canonicalized under the board symmetries if enabled
+  # States other than GameState use their own key() and no symmetries
   def serialize_state(self, playing, state):
-    if playing == self.mark:
-      serialized = "A"    # Agent
+    agent = 1 if playing == self.mark else 0
+    if not hasattr(state, "xbits"):
+      return (agent << 2*self.num_squares) | state.key()
+    if self.symmetry:
+      xbits, obits, _ = canonical(state.xbits, state.obits)
     else:
-      serialized = "O"    # Opponent
-    for i in range(3):
-      for j in range(3):
-        if state.grid[i][j] is None:
-          s = "_"
-        else:
-          s = state.grid[i][j]
-        serialized += s
-    return serialized
+      xbits, obits = state.xbits, state.obits
+    return (agent << 18) | (xbits << 9) | obits
 
   # Returns (action, score, depth) where score is the optimal expected score
   # (a maximum for the agent, a minimum for its opponent), the action
@@ -195,14 +403,19 @@ class MinimaxPlayer:
     # or tie, but also the depth required to reach it
     # The idea is that a win is preferable sooner, while a loss or tie is
     # preferable later
+    # The depth counted is the number of plays since the start of the game,
+    # so the score of a position doesn't depend on where the search started
+    # and can be cached across moves
+    # Wins score win_score (the number of squares plus one, 10 on the 3x3
+    # board) minus the depth, so they are always positive
     winner = state.get_winner()
     if winner is not None:
       if winner == self.mark:
-        return +10 - depth
+        return +self.win_score - state.plays
       elif winner == "tie":
         return 0
       elif winner == self.opp_mark:
-        return -10 + depth
+        return -self.win_score + state.plays
       else:
         print(self.mark, self.opp_mark)
         raise RuntimeError("Invalid winner:", winner)
@@ -216,6 +429,7 @@ class MinimaxPlayer:
       serialized = self.serialize_state(next_player, new_state)
       if serialized in self.cache:
         score = self.cache[serialized]
+        self.cache_hits += 1
       else:
         self.explored += 1
         score = self.minimax(next_player, new_state, depth+1)
@@ -241,4 +455,452 @@ class MinimaxPlayer:
     else:
       return best_score
 
+  # Returns the list of (play, score) for the agent's plays
+  # The best plays get their exact score; the rest only need to be shown to
+  # be worse than the best, so their score is an upper bound
+  def alphabeta_root(self, state):
+    play_scores = []
+    best_score = None
+    for play in self.order_plays(self.mark, state):
+      new_state = state.try_play_at(self.mark, play)
+      # Scores are integers, so a window just below the best score so far
+      # still returns the exact score of plays that tie with it
+      if best_score is None:
+        alpha = -INFINITY
+      else:
+        alpha = best_score - 1
+      score = self.alphabeta(self.opp_mark, new_state, alpha, +INFINITY)
+      play_scores.append((play, score))
+      if best_score is None or score > best_score:
+        best_score = score
+    return play_scores
+
+  # Returns the score of the state with cur_player to play, searching only
+  # within the (alpha, beta) window
+  # A result <= alpha is an upper bound of the true score, a result >= beta
+  # is a lower bound, and anything in between is exact
+  def alphabeta(self, cur_player, state, alpha, beta):
+
+    # End states are scored as in minimax()
+    winner = state.get_winner()
+    if winner is not None:
+      if winner == self.mark:
+        return +self.win_score - state.plays
+      elif winner == "tie":
+        return 0
+      elif winner == self.opp_mark:
+        return -self.win_score + state.plays
+      else:
+        raise RuntimeError("Invalid winner:", winner)
+
+    # Use the cached score, or narrow the window with a cached bound
+    serialized = self.serialize_state(cur_player, state)
+    entry = self.cache.get(serialized)
+    if entry is not None:
+      bound, score = entry
+      if bound == EXACT:
+        self.cache_hits += 1
+        return score
+      elif bound == LOWER:
+        alpha = max(alpha, score)
+      elif bound == UPPER:
+        beta = min(beta, score)
+      if alpha >= beta:
+        self.cache_hits += 1
+        return score
+    self.explored += 1
+
+    # Search the plays, stopping as soon as the score leaves the window
+    orig_alpha, orig_beta = alpha, beta
+    maximizer = cur_player == self.mark
+    next_player = "O" if cur_player == "X" else "X"
+    best_score = None
+    for play in self.order_plays(cur_player, state):
+      new_state = state.try_play_at(cur_player, play)
+      score = self.alphabeta(next_player, new_state, alpha, beta)
+      if maximizer:
+        if best_score is None or score > best_score:
+          best_score = score
+        alpha = max(alpha, score)
+      else:
+        if best_score is None or score < best_score:
+          best_score = score
+        beta = min(beta, score)
+      if alpha >= beta:
+        break
+
+    if best_score <= orig_alpha:
+      bound = UPPER
+    elif best_score >= orig_beta:
+      bound = LOWER
+    else:
+      bound = EXACT
+    self.cache[serialized] = (bound, best_score)
+    return best_score
+
+  # Returns the list of (play, score) of the deepest iteration of the
+  # depth-limited search that finished within the time limit
+  # If not even depth 1 finishes, returns the first play of order_plays()
+  # Each iteration searches the best plays of the previous one first; the
+  # cache is kept between iterations (and moves), each entry with the depth
+  # it was searched to
+  # If the state can undo plays, the search plays and undoes them on a
+  # single copy of it instead of copying it at every node (the copy is left
+  # mid-search when time runs out, and discarded)
+  def iterative_root(self, state):
+    if self.time_limit_ms is not None:
+      self.deadline = time.perf_counter() + self.time_limit_ms / 1000
+    else:
+      self.deadline = None
+    self.can_undo = hasattr(state, "undo")
+    if self.can_undo:
+      state = state.copy()
+    order = self.order_plays(self.mark, state)
+    max_depth = state.num_squares - state.plays
+    if self.max_depth is not None:
+      max_depth = min(max_depth, self.max_depth)
+    best_scores = [(order[0], 0)]
+    self.completed_depth = 0
+    for depth in range(1, max_depth+1):
+      self.heuristic_leaves = 0
+      try:
+        play_scores = self.limited_root(state, order, depth)
+      except SearchTimeout:
+        break
+      best_scores = play_scores
+      self.completed_depth = depth
+      # The search reached the end of every line: deeper ones won't change it
+      if self.heuristic_leaves == 0:
+        break
+      ranked = sorted(play_scores, key=lambda x: x[1], reverse=True)
+      order = [play for play, score in ranked]
+    if self.debug: print("Completed depth:", self.completed_depth)
+    return best_scores
+
+  # The root of the depth-limited search, like alphabeta_root(), trying the
+  # plays in the given order
+  def limited_root(self, state, order, depth):
+    play_scores = []
+    best_score = None
+    for play in order:
+      if self.can_undo:
+        state.play_at(self.mark, play)
+        new_state = state
+      else:
+        new_state = state.try_play_at(self.mark, play)
+      if best_score is None:
+        alpha = -INFINITY
+      else:
+        alpha = best_score - 1
+      score = self.limited(self.opp_mark, new_state, depth-1, alpha, +INFINITY)
+      if self.can_undo:
+        state.undo()
+      play_scores.append((play, score))
+      if best_score is None or score > best_score:
+        best_score = score
+    return play_scores
+
+  # Like alphabeta(), but stops depth plays below, scoring the positions
+  # there with the heuristic; raises SearchTimeout when time is up
+  # Cache entries are (bound, score, depth): a score searched to a depth is
+  # good for searches as deep or shallower, and one whose search never
+  # stopped at the depth limit has an infinite depth
+  def limited(self, cur_player, state, depth, alpha, beta):
+
+    winner = state.get_winner()
+    if winner is not None:
+      if winner == self.mark:
+        return +self.win_score - state.plays
+      elif winner == "tie":
+        return 0
+      elif winner == self.opp_mark:
+        return -self.win_score + state.plays
+      else:
+        raise RuntimeError("Invalid winner:", winner)
+    if self.deadline is not None and time.perf_counter() >= self.deadline:
+      raise SearchTimeout()
+    if depth == 0:
+      self.heuristic_leaves += 1
+      return self.heuristic(state, self.mark)
+
+    serialized = self.serialize_state(cur_player, state)
+    entry = self.cache.get(serialized)
+    if entry is not None and entry[2] >= depth:
+      bound, score, searched = entry
+      hit = False
+      if bound == EXACT:
+        hit = True
+      elif bound == LOWER:
+        alpha = max(alpha, score)
+      elif bound == UPPER:
+        beta = min(beta, score)
+      if hit or alpha >= beta:
+        self.cache_hits += 1
+        if searched != INFINITY:
+          self.heuristic_leaves += 1
+        return score
+    self.explored += 1
+
+    orig_alpha, orig_beta = alpha, beta
+    leaves = self.heuristic_leaves
+    maximizer = cur_player == self.mark
+    next_player = "O" if cur_player == "X" else "X"
+    best_score = None
+    for play in self.order_plays(cur_player, state):
+      if self.can_undo:
+        state.play_at(cur_player, play)
+        score = self.limited(next_player, state, depth-1, alpha, beta)
+        state.undo()
+      else:
+        new_state = state.try_play_at(cur_player, play)
+        score = self.limited(next_player, new_state, depth-1, alpha, beta)
+      if maximizer:
+        if best_score is None or score > best_score:
+          best_score = score
+        alpha = max(alpha, score)
+      else:
+        if best_score is None or score < best_score:
+          best_score = score
+        beta = min(beta, score)
+      if alpha >= beta:
+        break
+
+    if best_score <= orig_alpha:
+      bound = UPPER
+    elif best_score >= orig_beta:
+      bound = LOWER
+    else:
+      bound = EXACT
+    searched = INFINITY if self.heuristic_leaves == leaves else depth
+    self.cache[serialized] = (bound, best_score, searched)
+    return best_score
+
+  # Returns the legal plays of cur_player sorted so that the ones most likely
+  # to be best are searched first: immediate wins, then blocks of the
+  # opponent's wins, then the center, the corners and the edges (on other
+  # boards, the squares closest to the center)
+  def order_plays(self, cur_player, state):
+    opponent = "O" if cur_player == "X" else "X"
+    wins = state.winning_plays(cur_player)
+    blocks = [play for play in state.winning_plays(opponent) if play not in wins]
+    others = [play for play in state.get_legal_plays() if play not in wins and play not in blocks]
+    if hasattr(state, "xbits"):
+      others.sort(key=lambda play: SQUARE_PRIORITY[play])
+    else:
+      ci = (state.geometry[0] - 1) / 2
+      cj = (state.geometry[1] - 1) / 2
+      others.sort(key=lambda play: (play[0] - ci)**2 + (play[1] - cj)**2)
+    return wins + blocks + others
+
 # =====================================
+
+# A perfect player that looks up its plays in the precomputed table of all
+# reachable positions (see solver.py)
+# Plays exactly like MinimaxPlayer, but every play is a single lookup
+class TablePlayer:
+
+  def __init__(self, mark=None, debug=False):
+    self.name = "TablePlayer"
+    self.mark = mark
+    self.debug = debug
+    self.table = get_table()
+
+  # Receives a 3x3 game state and returns the position to play
+  def get_play(self, state):
+    value, distance, best_plays = self.table.lookup(*state_bits(state))
+    if len(best_plays) == 0:
+      raise RuntimeError("No legal plays possible!")
+    best_play = random.choice(best_plays)
+    if self.debug:
+      if value == +1:
+        expected_str = "WIN in %i plays" % distance
+      elif value == -1:
+        expected_str = "LOSS in %i plays" % distance
+      else:
+        expected_str = "TIE in %i plays" % distance
+      print("Best plays:", best_plays)
+      print("Expected result:", expected_str)
+      print("Selected play:", best_play)
+    return best_play
+
+  # Returns the list of (play, probability) of the plays get_play may return
+  def get_play_distribution(self, state):
+    value, distance, best_plays = self.table.lookup(*state_bits(state))
+    return [(play, 1/len(best_plays)) for play in best_plays]
+
+# =====================================
+
+# A node of the MCTSPlayer search tree: a position, with the results of the
+# playouts through it from the point of view of the player who moved into it
+# Children are shared by all the paths that reach the same position
+class MCTSNode:
+
+  def __init__(self, state):
+    self.key = state.key()
+    self.mover = "X" if state.plays % 2 == 1 else "O"
+    if state.get_winner() is None:
+      self.untried = state.get_legal_plays()
+    else:
+      self.untried = []
+    self.children = {}
+    self.visits = 0
+    self.score = 0.0
+
+# A Monte Carlo Tree Search player (UCT)
+# Each iteration walks down the tree choosing the children with the best
+# upper confidence bound, adds a new node, finishes the game with random
+# plays and adds the result to the nodes on the path
+# The search stops after iterations iterations or time_limit_ms
+# milliseconds, whichever comes first (either may be None, not both)
+# exploration is the UCT exploration constant
+# With reuse=True the nodes below the current position are kept from one
+# move to the next, found by their state keys
+# stats is an optional instrument.Stats to which every search adds its
+# number of iterations and of new and reused nodes
+# Works on any state with the GameState interface and random_play()
+class MCTSPlayer:
+
+  def __init__(self, mark=None, iterations=1000, time_limit_ms=None, exploration=1.4, reuse=True, debug=False, stats=None):
+    if iterations is None and time_limit_ms is None:
+      raise RuntimeError("MCTSPlayer needs an iteration or time budget")
+    self.name = "MCTSPlayer"
+    self.mark = mark
+    # Its plays depend on random playouts, with no distribution to list
+    self.deterministic = False
+    self.iterations = iterations
+    self.time_limit_ms = time_limit_ms
+    self.exploration = exploration
+    self.reuse = reuse
+    self.debug = debug
+    self.stats = stats
+    self.nodes = {}
+    self.geometry = None
+
+  # Receives a GameState and returns the position to play
+  def get_play(self, state):
+    if state.get_winner() is not None or len(state.get_legal_plays()) == 0:
+      raise RuntimeError("No legal plays possible!")
+
+    # Keep only the part of the previous tree below this position (keys are
+    # only comparable between states of one board size)
+    if state.geometry != self.geometry:
+      self.nodes = {}
+      self.geometry = state.geometry
+    root = self.nodes.get(state.key()) if self.reuse else None
+    if root is None:
+      root = MCTSNode(state)
+      self.nodes = {root.key: root}
+    else:
+      self.prune(root)
+    reused = len(self.nodes)
+
+    # Plays and undoes on a single copy if the state can undo plays,
+    # otherwise copies the state every iteration
+    can_undo = hasattr(state, "undo")
+    board = state.copy()
+    if self.time_limit_ms is not None:
+      deadline = time.perf_counter() + self.time_limit_ms / 1000
+    iterations = 0
+    while self.iterations is None or iterations < self.iterations:
+      if self.time_limit_ms is not None and iterations > 0 and time.perf_counter() >= deadline:
+        break
+      if not can_undo:
+        board = state.copy()
+      self.iterate(root, board)
+      iterations += 1
+
+    # The most visited play is the most reliable
+    best_play = None
+    best_visits = -1
+    for play, child in root.children.items():
+      if child.visits > best_visits:
+        best_play = play
+        best_visits = child.visits
+
+    if self.debug:
+      print("Iterations: %i, tree size: %i (%i reused)" % (iterations, len(self.nodes), reused))
+      for play, child in sorted(root.children.items(), key=lambda x: -x[1].visits):
+        print(play, "%i visits, %.3f" % (child.visits, child.score / child.visits))
+      print("Selected play:", best_play)
+    if self.stats is not None:
+      self.stats.count(self.name + ".iterations", iterations)
+      self.stats.count(self.name + ".nodes", len(self.nodes) - reused)
+      self.stats.count(self.name + ".reused_nodes", reused)
+
+    return best_play
+
+  # Runs one iteration of the search from root, playing on board (a copy of
+  # the root position, which is restored on return if it can undo plays)
+  def iterate(self, root, board):
+
+    # Selection: descend through fully expanded nodes
+    node = root
+    path = [root]
+    to_play = "O" if root.mover == "X" else "X"
+    plays = 0
+    while len(node.untried) == 0 and len(node.children) > 0:
+      play, node = self.select(node)
+      board.play_at(to_play, play)
+      plays += 1
+      to_play = "O" if to_play == "X" else "X"
+      path.append(node)
+
+    # Expansion: add a node for one untried play (a position already in the
+    # tree through another path is shared)
+    if len(node.untried) > 0:
+      play = node.untried.pop(random.randrange(len(node.untried)))
+      board.play_at(to_play, play)
+      plays += 1
+      to_play = "O" if to_play == "X" else "X"
+      child = self.nodes.get(board.key())
+      if child is None:
+        child = MCTSNode(board)
+        self.nodes[child.key] = child
+      node.children[play] = child
+      path.append(child)
+
+    # Playout: random plays to the end of the game
+    winner = board.get_winner()
+    while winner is None:
+      board.play_at(to_play, board.random_play())
+      plays += 1
+      to_play = "O" if to_play == "X" else "X"
+      winner = board.get_winner()
+
+    # Backpropagation
+    for node in path:
+      node.visits += 1
+      if winner == node.mover:
+        node.score += 1
+      elif winner == "tie":
+        node.score += 0.5
+
+    if hasattr(board, "undo"):
+      for _ in range(plays):
+        board.undo()
+
+  # Returns the (play, child) of node with the highest upper confidence bound
+  def select(self, node):
+    log_visits = math.log(node.visits)
+    best = None
+    best_ucb = None
+    for play, child in node.children.items():
+      if child.visits == 0:
+        return play, child
+      ucb = child.score / child.visits + self.exploration * math.sqrt(log_visits / child.visits)
+      if best_ucb is None or ucb > best_ucb:
+        best = (play, child)
+        best_ucb = ucb
+    return best
+
+  # Drops the nodes that can't be reached from root
+  def prune(self, root):
+    nodes = {root.key: root}
+    pending = [root]
+    while len(pending) > 0:
+      node = pending.pop()
+      for child in node.children.values():
+        if child.key not in nodes:
+          nodes[child.key] = child
+          pending.append(child)
+    self.nodes = nodes
@@ -0,0 +1,299 @@
+# Compact binary records of tic-tac-toe games, and their analysis
+# Games are appended to a file as they are played (see TicTacToe's sink and
+# trials.evaluate_player) and read back one at a time by a generator, so that
+# files of millions of games can be analyzed in constant memory
+#
+# The file is a stream of records:
+# - Session marker (1 byte): 0xFE. Written every time a writer opens the
+#   file; player ids are only valid until the next marker
+# - Player name (3 + length bytes): 0xFF, the player id, the length of the
+#   name and the name in UTF-8. Written the first time a player appears in
+#   a session
+# - Game (8 bytes): the number of moves (low nibble) and the result (high
+#   nibble: 0 tie, 1 X won, 2 O won, 3 unfinished), the ids of the X and O
+#   players, and the squares k = 3*i + j of the moves as nibbles, the first
+#   in the low nibble of the fourth byte, unused nibbles set to 0xF
+import os
+from bitboard import SQUARE_BITS, POSITIONS
+from solver import get_table, TERNARY
+
+# ==============================================================================
+
+SESSION = 0xFE
+NAME = 0xFF
+GAME_SIZE = 8
+MAX_PLAYERS = 255
+MAX_NAME_BYTES = 255
+
+# Result codes of the game records
+RESULTS = {"tie": 0, "X": 1, "O": 2, None: 3}
+RESULT_NAMES = {code: result for result, code in RESULTS.items()}
+
+# NIBBLES[byte] is the pair (low nibble, high nibble) of a byte
+NIBBLES = [(byte & 0xF, byte >> 4) for byte in range(256)]
+
+# Encodes a game as the 8 bytes of its record
+# moves is the list of (i,j) squares played, starting from the empty board
+def encode_game(xid, oid, moves, winner):
+  if len(moves) > 9:
+    raise RuntimeError("Too many moves for a game record: %i" % len(moves))
+  squares = [3*i + j for i,j in moves] + [0xF] * (10 - len(moves))
+  record = bytearray([len(moves) | RESULTS[winner] << 4, xid, oid])
+  for m in range(0, 10, 2):
+    record.append(squares[m] | squares[m+1] << 4)
+  return record
+
+# =====================================
+
+# Appends game records to a file
+# Records are buffered and written every buffer_size bytes, and on close()
+class RecordWriter:
+
+  def __init__(self, fname, buffer_size=65536):
+    self.fname = fname
+    self.buffer_size = buffer_size
+    self.f = open(fname, "ab")
+    self.buffer = bytearray([SESSION])
+    self.ids = {}
+    self.num_games = 0
+
+  # Returns the id of a player name, writing its record if it's new
+  # Names must be at most MAX_NAME_BYTES long in UTF-8
+  def player_id(self, name):
+    if name not in self.ids:
+      if len(self.ids) >= MAX_PLAYERS:
+        raise RuntimeError("Too many players in a session of records")
+      encoded = name.encode()
+      if len(encoded) > MAX_NAME_BYTES:
+        raise RuntimeError("Player name too long for a record: %s" % name)
+      self.ids[name] = len(self.ids)
+      self.buffer += bytes([NAME, self.ids[name], len(encoded)]) + encoded
+    return self.ids[name]
+
+  # Adds a game between the named players; moves is the list of (i,j)
+  # squares played from the empty board and winner "X", "O", "tie" or None
+  def add(self, xname, oname, moves, winner):
+    xid = self.player_id(xname)
+    oid = self.player_id(oname)
+    self.buffer += encode_game(xid, oid, moves, winner)
+    self.num_games += 1
+    if len(self.buffer) >= self.buffer_size:
+      self.flush()
+
+  # Adds a finished TicTacToe game
+  def write_game(self, game):
+    if game.gamestate.geometry != (3, 3, 3) or len(game.moves) != game.gamestate.plays:
+      raise RuntimeError("Only 3x3 games from the empty board can be recorded")
+    self.add(game.playerX.name, game.playerO.name, game.moves, game.winner)
+
+  # Writes the buffered records to the file
+  def flush(self):
+    self.f.write(self.buffer)
+    self.f.flush()
+    self.buffer = bytearray()
+
+  def close(self):
+    self.flush()
+    self.f.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+# Keeps games in a list instead of writing them, with the interface of
+# RecordWriter (used by worker processes, whose games are written by the
+# parent process)
+class GameList:
+
+  def __init__(self):
+    self.games = []
+
+  def add(self, xname, oname, moves, winner):
+    self.games.append((xname, oname, list(moves), winner))
+
+  def write_game(self, game):
+    if game.gamestate.geometry != (3, 3, 3) or len(game.moves) != game.gamestate.plays:
+      raise RuntimeError("Only 3x3 games from the empty board can be recorded")
+    self.add(game.playerX.name, game.playerO.name, game.moves, game.winner)
+
+# =====================================
+
+# Reads the games of a records file one at a time
+# Yields (xname, oname, squares, winner) for every game: squares is the
+# list of square indices k = 3*i + j of its moves
+def read_games(fname, chunk_size=1 << 20):
+  f = open(fname, "rb")
+  names = {}
+  data = b""
+  pos = 0
+  try:
+    while True:
+      # Keep at least one whole record (of up to 258 bytes) in data, unless
+      # the file ends first
+      if len(data) - pos < 258:
+        data = data[pos:]
+        pos = 0
+        while len(data) < 258:
+          chunk = f.read(chunk_size)
+          if len(chunk) == 0:
+            break
+          data += chunk
+        if len(data) == 0:
+          break
+      tag = data[pos]
+      if tag == SESSION:
+        names = {}
+        pos += 1
+      elif tag == NAME:
+        if pos + 3 > len(data) or pos + 3 + data[pos+2] > len(data):
+          raise RuntimeError("Truncated records file: %s" % fname)
+        length = data[pos+2]
+        names[data[pos+1]] = data[pos+3:pos+3+length].decode()
+        pos += 3 + length
+      else:
+        if pos + GAME_SIZE > len(data):
+          raise RuntimeError("Truncated records file: %s" % fname)
+        num_moves = tag & 0xF
+        squares = []
+        for byte in data[pos+3:pos+8]:
+          squares.extend(NIBBLES[byte])
+        yield (names[data[pos+1]], names[data[pos+2]], squares[:num_moves], RESULT_NAMES[tag >> 4])
+        pos += GAME_SIZE
+  finally:
+    f.close()
+
+# =====================================
+
+# Statistics of a stream of games, accumulated one game at a time
+# openings[first moves] = [games, X wins, ties, O wins] for the openings of
+#   opening_depth moves
+# moves[(ply, square)] = [games, wins, ties, losses] of the player who made
+#   that move at that ply (0 is the first move)
+# players[name] = [moves, blunders]: a blunder is a move that makes the
+#   perfect-play result of the mover worse (a win into a tie or loss, or a
+#   tie into a loss), according to the solver table
+# blunders_by_ply[ply] = number of blunders at each ply
+class Analysis:
+
+  def __init__(self, opening_depth=2):
+    self.opening_depth = opening_depth
+    self.table = get_table()
+    self.num_games = 0
+    self.results = {"X": 0, "O": 0, "tie": 0, None: 0}
+    self.openings = {}
+    self.moves = {}
+    self.players = {}
+    self.blunders_by_ply = [0] * 9
+
+  # Adds a game as yielded by read_games()
+  def add(self, xname, oname, squares, winner):
+    self.num_games += 1
+    self.results[winner] += 1
+
+    opening = tuple(squares[:self.opening_depth])
+    if opening not in self.openings:
+      self.openings[opening] = [0, 0, 0, 0]
+    counts = self.openings[opening]
+    counts[0] += 1
+    if winner == "X":
+      counts[1] += 1
+    elif winner == "tie":
+      counts[2] += 1
+    elif winner == "O":
+      counts[3] += 1
+
+    for name in (xname, oname):
+      if name not in self.players:
+        self.players[name] = [0, 0]
+
+    value = self.table.value
+    xbits = 0
+    obits = 0
+    for ply, k in enumerate(squares):
+      mover = "X" if ply % 2 == 0 else "O"
+
+      if (ply, k) not in self.moves:
+        self.moves[(ply, k)] = [0, 0, 0, 0]
+      counts = self.moves[(ply, k)]
+      counts[0] += 1
+      if winner == mover:
+        counts[1] += 1
+      elif winner == "tie":
+        counts[2] += 1
+      elif winner is not None:
+        counts[3] += 1
+
+      # Perfect-play result for the mover before and after the move
+      before = value[TERNARY[xbits] + 2*TERNARY[obits]]
+      if mover == "X":
+        xbits |= SQUARE_BITS[k]
+      else:
+        obits |= SQUARE_BITS[k]
+      after = -value[TERNARY[xbits] + 2*TERNARY[obits]]
+      stats = self.players[xname if mover == "X" else oname]
+      stats[0] += 1
+      if after < before:
+        stats[1] += 1
+        self.blunders_by_ply[ply] += 1
+
+  # Prints the statistics
+  def show(self, top=10):
+    print("{:,} games: X won {:,}, O won {:,}, {:,} ties".format(self.num_games,
+      self.results["X"], self.results["O"], self.results["tie"]))
+
+    print("\nMost played openings (X wins / ties / O wins):")
+    ranked = sorted(self.openings.items(), key=lambda x: -x[1][0])
+    for opening, (games, xwins, ties, owins) in ranked[:top]:
+      plays = " ".join("%i,%i" % POSITIONS[k] for k in opening)
+      print("  %-24s %9i  %.3f / %.3f / %.3f" % (plays, games, xwins/games, ties/games, owins/games))
+
+    print("\nScore of the mover by ply and square (wins + ties/2):")
+    for ply in range(9):
+      cells = []
+      for k in range(9):
+        counts = self.moves.get((ply, k))
+        if counts is None or counts[0] == 0:
+          cells.append("    -")
+        else:
+          cells.append("%5.2f" % ((counts[1] + counts[2]/2) / counts[0]))
+      print("  ply %i: %s" % (ply, " ".join(cells)))
+
+    print("\nBlunders by player:")
+    for name, (moves, blunders) in sorted(self.players.items()):
+      if moves > 0:
+        print("  %-20s %9i moves, %9i blunders (%.2f%%)" % (name, moves, blunders, 100*blunders/moves))
+    print("Blunders by ply:", self.blunders_by_ply)
+
+# Analyzes all the games of a records file
+def analyze(fname, opening_depth=2):
+  analysis = Analysis(opening_depth)
+  for game in read_games(fname):
+    analysis.add(*game)
+  return analysis
+
+# ==============================================================================
+
+if __name__ == "__main__":
+
+  import sys
+  import datetime
+  from players import RandomPlayer, BlockingPlayer
+  from trials import evaluate_player
+
+  if len(sys.argv) > 1:
+    fname = sys.argv[1]
+  else:
+    # Record some games to analyze
+    fname = "games.rec"
+    writer = RecordWriter(fname)
+    evaluate_player(BlockingPlayer(quiet=True), 100000, opponent=RandomPlayer(quiet=True), sink=writer)
+    writer.close()
+    print("Recorded {:,} games in {} ({:,} bytes)".format(writer.num_games, fname, os.path.getsize(fname)))
+
+  start = datetime.datetime.now()
+  analysis = analyze(fname)
+  elapsed = (datetime.datetime.now() - start).total_seconds()
+  analysis.show()
+  print("Analyzed in %.2fs" % elapsed)
@@ -0,0 +1,155 @@
+# Perfect-play table for tic-tac-toe
+# Tic-tac-toe has only 5,478 legal reachable positions, so we solve all of
+# them once and store the result in flat arrays indexed by the base-3
+# encoding of the board (0 = empty, 1 = X, 2 = O, square k has weight 3^k)
+from array import array
+from bitboard import FULL, SQUARE_BITS, POSITIONS, WINNING, POPCOUNT
+
+# ==============================================================================
+
+# Number of base-3 board indices
+NUM_INDICES = 3**9
+
+# Marks unreachable positions in the value table
+UNREACHABLE = -128
+
+# TERNARY[bits] is the base-3 index of a board holding only X's at bits;
+# the index of a full board is TERNARY[xbits] + 2*TERNARY[obits]
+TERNARY = [sum(3**k for k in range(9) if bits >> k & 1) for bits in range(512)]
+
+# Returns the score of a play for the player making it, given its result
+# (+1, 0 or -1) and the number of plays until the game ends
+# Wins are preferred sooner and losses later, as in MinimaxPlayer
+def play_score(result, distance):
+  if result > 0:
+    return 10 - distance
+  elif result < 0:
+    return -10 + distance
+  else:
+    return 0
+
+# =====================================
+
+# The solved game
+# For every reachable position, from the point of view of the player to move:
+# value[idx]: +1 (win), 0 (tie) or -1 (loss) under perfect play, or
+#   UNREACHABLE if the position cannot occur in a game
+# distance[idx]: number of plays until the game ends under perfect play
+# best[idx]: bitmask of the squares that achieve the best play score
+class PerfectPlayTable:
+
+  # Solves the game, or loads a previously saved table from fname
+  def __init__(self, fname=None):
+    if fname is not None:
+      self.load(fname)
+    else:
+      self.solve()
+
+  # Solves every reachable position by a memoized walk from the empty board
+  def solve(self):
+    self.value = array("b", [UNREACHABLE]) * NUM_INDICES
+    self.distance = array("b", [0]) * NUM_INDICES
+    self.best = array("H", [0]) * NUM_INDICES
+    self.num_positions = 0
+    self._solve(0, 0)
+
+  # Solves the position and returns (value, distance) for the player to move
+  def _solve(self, xbits, obits):
+    idx = TERNARY[xbits] + 2*TERNARY[obits]
+    if self.value[idx] != UNREACHABLE:
+      return self.value[idx], self.distance[idx]
+    self.num_positions += 1
+
+    # End states: if someone has won it was the previous player
+    occupied = xbits | obits
+    if WINNING[xbits] or WINNING[obits]:
+      value = -1
+      distance = 0
+      best = 0
+    elif occupied == FULL:
+      value = 0
+      distance = 0
+      best = 0
+
+    # Otherwise evaluate every play and keep those with the best score
+    else:
+      x_to_play = POPCOUNT[xbits] == POPCOUNT[obits]
+      best_score = None
+      for k in range(9):
+        bit = SQUARE_BITS[k]
+        if occupied & bit:
+          continue
+        if x_to_play:
+          child_value, child_distance = self._solve(xbits | bit, obits)
+        else:
+          child_value, child_distance = self._solve(xbits, obits | bit)
+        score = play_score(-child_value, child_distance + 1)
+        if best_score is None or score > best_score:
+          best_score = score
+          value = -child_value
+          distance = child_distance + 1
+          best = bit
+        elif score == best_score:
+          best |= bit
+
+    self.value[idx] = value
+    self.distance[idx] = distance
+    self.best[idx] = best
+    return value, distance
+
+  # Returns (value, distance, best_plays) for the player to move in the
+  # position given by the two bitboards; best_plays is a list of (i,j)
+  def lookup(self, xbits, obits):
+    idx = TERNARY[xbits] + 2*TERNARY[obits]
+    value = self.value[idx]
+    if value == UNREACHABLE:
+      raise RuntimeError("Unreachable position!")
+    best = self.best[idx]
+    best_plays = [POSITIONS[k] for k in range(9) if best >> k & 1]
+    return value, self.distance[idx], best_plays
+
+  # Saves the table as a flat binary file
+  def save(self, fname):
+    f = open(fname, "wb")
+    self.value.tofile(f)
+    self.distance.tofile(f)
+    self.best.tofile(f)
+    f.close()
+
+  # Loads a table saved with save()
+  def load(self, fname):
+    self.value = array("b")
+    self.distance = array("b")
+    self.best = array("H")
+    f = open(fname, "rb")
+    self.value.fromfile(f, NUM_INDICES)
+    self.distance.fromfile(f, NUM_INDICES)
+    self.best.fromfile(f, NUM_INDICES)
+    f.close()
+    self.num_positions = NUM_INDICES - self.value.count(UNREACHABLE)
+
+# =====================================
+
+# The table is solved once per process, the first time it's needed
+_table = None
+
+# Returns the shared perfect-play table
+def get_table():
+  global _table
+  if _table is None:
+    _table = PerfectPlayTable()
+  return _table
+
+# ==============================================================================
+
+if __name__ == "__main__":
+
+  import datetime
+
+  start = datetime.datetime.now()
+  table = PerfectPlayTable()
+  elapsed = (datetime.datetime.now() - start).total_seconds()
+  print("Solved {:,} positions in {:.3f}s".format(table.num_positions, elapsed))
+
+  value, distance, best_plays = table.lookup(0, 0)
+  print("Empty board: value %i in %i plays, best plays %s" % (value, distance, best_plays))
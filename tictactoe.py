@@ -1,57 +1,134 @@
-from copy import deepcopy
 import random
+import time
+from bitboard import FULL, SQUARE_BITS, WINNING, POPCOUNT, LEGAL_PLAYS, COMPLETIONS, SQUARE_PLAYS
 from players import *
 
 # ==============================================================================
 
 # The game state
+# Stored as two 9-bit integers (one per mark) so that copying a state and
+# checking for a winner are a couple of integer operations
 class GameState:
 
+  # Board size (rows, columns, marks in a row to win), as in mnk.MNKState
+  geometry = (3, 3, 3)
+  num_squares = 9
+
   # Creates a new game
   # The state ot the grid (a "3x3" python list) is an optional argument
   # Each "square" holds either "X", "O" or None
   def __init__(self, grid=None):
     if grid is None:
-      self.grid = [[None,None,None],[None,None,None],[None,None,None]]
+      self.xbits = 0
+      self.obits = 0
       self.plays = 0
     else:
-      self.grid = deepcopy(grid)
-      self.plays = self.count_plays()
+      self.grid = grid
+
+  # Builds a state directly from the bitboards, bypassing the grid
+  @classmethod
+  def from_bits(cls, xbits, obits):
+    state = cls.__new__(cls)
+    state.xbits = xbits
+    state.obits = obits
+    state.plays = POPCOUNT[xbits | obits]
+    return state
+
+  # The grid as a "3x3" python list of "X", "O" or None
+  # This is a fresh copy: modifying it does not change the state
+  @property
+  def grid(self):
+    grid = []
+    for i in range(3):
+      row = []
+      for j in range(3):
+        bit = SQUARE_BITS[3*i+j]
+        if self.xbits & bit:
+          row.append("X")
+        elif self.obits & bit:
+          row.append("O")
+        else:
+          row.append(None)
+      grid.append(row)
+    return grid
+
+  # Loads the state from a "3x3" python list
+  @grid.setter
+  def grid(self, grid):
+    self.xbits = 0
+    self.obits = 0
+    for i in range(3):
+      for j in range(3):
+        if grid[i][j] == "X":
+          self.xbits |= SQUARE_BITS[3*i+j]
+        elif grid[i][j] == "O":
+          self.obits |= SQUARE_BITS[3*i+j]
+        elif grid[i][j] is not None:
+          raise RuntimeError("Illegal symbol found in grid!")
+    self.plays = self.count_plays()
 
   # Plays for player ("X" or "O") at pos (i,j)
   def play_at(self, player, pos):
     i,j = pos
-    if self.grid[i][j] is not None:
+    bit = SQUARE_BITS[3*i+j]
+    if (self.xbits | self.obits) & bit:
       raise RuntimeError("Illegal play!")
-    self.grid[i][j] = player
+    if player == "X":
+      self.xbits |= bit
+    elif player == "O":
+      self.obits |= bit
+    else:
+      raise RuntimeError("Invalid player: %s" % str(player))
     self.plays += 1
 
   # Returns the gamestate that results from player playing at pos
   def try_play_at(self, player, pos):
     i,j = pos
-    if self.grid[i][j] is not None:
+    bit = SQUARE_BITS[3*i+j]
+    if (self.xbits | self.obits) & bit:
       raise RuntimeError("Illegal play!")
-    newstate = GameState(self.grid)
-    newstate.play_at(player, pos)
+    newstate = GameState.__new__(GameState)
+    if player == "X":
+      newstate.xbits = self.xbits | bit
+      newstate.obits = self.obits
+    elif player == "O":
+      newstate.xbits = self.xbits
+      newstate.obits = self.obits | bit
+    else:
+      raise RuntimeError("Invalid player: %s" % str(player))
+    newstate.plays = self.plays + 1
     return newstate
 
+  # Returns a hashable key that identifies the position
+  def key(self):
+    return (self.xbits << 9) | self.obits
+
+  # Returns an independent copy of the state
+  def copy(self):
+    return GameState.from_bits(self.xbits, self.obits)
+
   # Returns the list of (i,j) squares of legal plays (i.e. unplayed squares)
   def get_legal_plays(self):
-    legal_plays = []
-    for i in range(3):
-      for j in range(3):
-        if self.grid[i][j] is None:
-          legal_plays.append((i,j))
-    return legal_plays
+    return list(LEGAL_PLAYS[self.xbits | self.obits])
+
+  # Returns a random legal play (for fast playouts)
+  def random_play(self):
+    return random.choice(LEGAL_PLAYS[self.xbits | self.obits])
+
+  # Returns the list of (i,j) squares where player ("X" or "O") would
+  # complete a line, in board order
+  def winning_plays(self, player):
+    if player == "X":
+      mine = self.xbits
+    elif player == "O":
+      mine = self.obits
+    else:
+      raise RuntimeError("Invalid player: %s" % str(player))
+    return list(SQUARE_PLAYS[COMPLETIONS[mine] & ~(self.xbits | self.obits)])
 
   # Counts the number of played squares
   def count_plays(self):
-    count = 0
-    for i in range(3):
-      for j in range(3):
-        if self.grid[i][j] is not None:
-          count += 1
-    return count
+    return POPCOUNT[self.xbits | self.obits]
 
   # Returns whether the grid has no played squares
   def is_empty(self):
@@ -59,55 +136,37 @@ class GameState:
 
   # Returns whether the grid has no unplayed squares left
   def is_full(self):
-    return self.plays == 9
+    return (self.xbits | self.obits) == FULL
 
   # Returns whether the game state is a winning position (three in line)
+  # A full board (a tie) counts as well, i.e. this is whether the game is over
   def is_winning(self):
     return self.get_winner() is not None
 
   # Returns the winner of the game state: the player or 0 if no winner
   def get_winner(self):
-    winners = []
-    for player in ["X", "O"]:
-      # Rows
-      for i in range(3):
-        if self.grid[i][0] == self.grid[i][1] == self.grid[i][2] == player:
-          if player not in winners:
-            winners.append(player)
-          continue
-      # Columns
-      for j in range(3):
-        if self.grid[0][j] == self.grid[1][j] == self.grid[2][j] == player:
-          if player not in winners:
-            winners.append(player)
-          continue
-      # Diagonals
-      if (self.grid[0][0] == self.grid[1][1] == self.grid[2][2] == player)\
-      or (self.grid[0][2] == self.grid[1][1] == self.grid[2][0] == player):
-        if player not in winners:
-          winners.append(player)
-    if len(winners) == 0:
-      if self.is_full():
-        return "tie"
-      else:
-        return None
-    elif len(winners) == 1:
-      return winners[0]
+    if WINNING[self.xbits]:
+      if WINNING[self.obits]:
+        raise RuntimeError("Illegal board with 2 winners!")
+      return "X"
+    elif WINNING[self.obits]:
+      return "O"
+    elif (self.xbits | self.obits) == FULL:
+      return "tie"
     else:
-      raise RuntimeError("Illegal board with 2 winners!")
+      return None
 
   # ASCII representation of the game state
   def show(self):
+    grid = self.grid
     for i in range(3):
       s = ""
       for j in range(3):
         s += " "
-        if self.grid[i][j] is None:
+        if grid[i][j] is None:
           symb = " "
-        elif self.grid[i][j] in ["X","O"]:
-          symb = self.grid[i][j]
         else:
-          raise RuntimeError("Illegal symbol found in grid!")
+          symb = grid[i][j]
         s += symb
         if j != 2:
           s += " |"
@@ -122,20 +181,36 @@ class TicTacToe():
 
   # Initializes a new game
   # playerX and playerO must be Player objects
-  def __init__(self, playerX, playerO, quiet=False):
+  # stats is an optional instrument.Stats that records the duration of the
+  # game and of every move
+  # state is the initial state (an empty GameState by default); any state
+  # with the GameState interface works, e.g. an mnk.MNKState
+  # sink is an optional records.RecordWriter (or anything with its
+  # write_game method) that receives the game when it ends
+  def __init__(self, playerX, playerO, quiet=False, stats=None, state=None, sink=None):
     self.playerX = playerX
     self.playerO = playerO
     self.quiet = quiet
+    self.stats = stats
+    self.sink = sink
+    self.moves = []
+    self.winner = None
     self.playerX.mark = "X"
     self.playerO.mark = "O"
     self.plays = 0
     self.ended = False
-    self.gamestate = GameState()
-    self.to_play = "X"
+    if state is None:
+      state = GameState()
+    self.gamestate = state
+    self.to_play = "X" if state.plays % 2 == 0 else "O"
 
   # Plays the game
   def play(self):
 
+    stats = self.stats
+    if stats is not None:
+      game_start = time.perf_counter()
+
     while True:
       if self.to_play == "X":
         player = self.playerX
@@ -147,10 +222,16 @@ class TicTacToe():
         print()
         print("\n== Player %s's turn (%s) ==" % (player.mark, player.name))
         self.gamestate.show()
-      play = player.get_play(self.gamestate)
+      if stats is not None:
+        move_start = time.perf_counter()
+        play = player.get_play(self.gamestate)
+        stats.record_move(player.name, time.perf_counter() - move_start)
+      else:
+        play = player.get_play(self.gamestate)
       if not self.quiet:
         print("\nPlayer %s plays at %s" % (player.mark, play))
       self.gamestate.play_at(player.mark, play)
+      self.moves.append(play)
       self.plays += 1
       self.to_play = "O" if self.to_play == "X" else "X"
       winner = self.gamestate.get_winner()
@@ -158,6 +239,11 @@ class TicTacToe():
         break
 
     self.ended = True
+    self.winner = winner
+    if self.sink is not None:
+      self.sink.write_game(self)
+    if stats is not None:
+      stats.record_games(1, time.perf_counter() - game_start)
     if not self.quiet:
       if winner == "tie":
         print("\nGAME TIED!")
@@ -203,7 +289,10 @@ if __name__ == "__main__":
   # RandomPlayer: plays at random
   # OpportunistPlayer: plays winning move if it can, random otherwise
   # BlockingPlayer: blocks opponent's winning move if it can, random otherwise
+  # WinBlockPlayer: plays winning move if it can, blocks if it can, random otherwise
   # MinimaxPlayer: a full Minimax agent. Plays almost perfectly.
+  # TablePlayer: perfect play from a precomputed table of all positions
+  # MCTSPlayer: Monte Carlo Tree Search with a budget of iterations or time
   # HumanPlayer: a human playing through the terminal
   playerX = MinimaxPlayer(debug=True)
   playerO = HumanPlayer()
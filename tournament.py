@@ -0,0 +1,255 @@
+# Round-robin tournaments between players
+# Every pair of players in the roster plays num_games games with each of
+# them playing X, the games being split in blocks that run across a pool of
+# processes; results are tallied as they arrive
+# From the results a cross-table and Bradley-Terry ratings (on the Elo
+# scale) with confidence bounds are computed
+# Usage: python tournament.py random opportunist blocking minimax best.nn
+#   [--games 1000] [--workers 4] [--seed 0] [--anchor random]
+import argparse
+import datetime
+import math
+import multiprocessing
+import os
+import random
+from statistics import NormalDist
+import numpy as np
+from tictactoe import TicTacToe
+from players import RandomPlayer, OpportunistPlayer, BlockingPlayer, WinBlockPlayer, MinimaxPlayer, TablePlayer, MCTSPlayer
+from NNPlayer import NNPlayer
+
+# ==============================================================================
+
+# Built-in players of the roster by name; anything else is taken as the file
+# name of a neural network for an NNPlayer
+PLAYERS = {
+  "random": lambda: RandomPlayer(quiet=True),
+  "opportunist": lambda: OpportunistPlayer(quiet=True),
+  "blocking": lambda: BlockingPlayer(quiet=True),
+  "winblock": lambda: WinBlockPlayer(quiet=True),
+  "minimax": lambda: MinimaxPlayer(),
+  "alphabeta": lambda: MinimaxPlayer(search="alphabeta"),
+  "table": lambda: TablePlayer(),
+  "mcts": lambda: MCTSPlayer(),
+}
+
+# Returns a new player from its roster entry
+def make_player(spec):
+  if spec in PLAYERS:
+    return PLAYERS[spec]()
+  if not os.path.exists(spec):
+    raise RuntimeError("Unknown player: %s" % str(spec))
+  return NNPlayer(fname=spec)
+
+# Returns the name under which a roster entry is reported
+def player_label(spec):
+  if spec in PLAYERS:
+    return spec
+  return os.path.basename(spec)
+
+# Players built by this process, by roster entry and mark, so that searching
+# players keep their caches from one block of games to the next
+_players = {}
+
+# Returns this process's player for a roster entry and mark
+def get_player(spec, mark):
+  key = (spec, mark)
+  if key not in _players:
+    _players[key] = make_player(spec)
+  return _players[key]
+
+# Plays a block of games of the tournament
+# Receives (x, o, spec_x, spec_o, num_games, seed) and returns
+# (x, o, x wins, ties, o wins)
+# A module-level function so that it can be run by the pool workers
+def _play_block_task(args):
+  x, o, spec_x, spec_o, num_games, seed = args
+  random.seed(seed)
+  playerX = get_player(spec_x, "X")
+  playerO = get_player(spec_o, "O")
+  xwins = ties = owins = 0
+  for _ in range(num_games):
+    winner = TicTacToe(playerX, playerO, quiet=True).play()
+    if winner == "X":
+      xwins += 1
+    elif winner == "O":
+      owins += 1
+    else:
+      ties += 1
+  return (x, o, xwins, ties, owins)
+
+# =====================================
+
+# Fits Bradley-Terry strengths to pairwise results
+# wins[i,j] is the score of i against j (ties counting 1/2) and games[i,j]
+# the number of games between them (symmetric)
+# Uses the MM iterations of Hunter (2004); returns the log-strengths theta,
+# centered on zero, and their covariance matrix (the pseudo-inverse of the
+# Fisher information, as the mean of theta is fixed)
+def bradley_terry(wins, games, max_iters=10000, tol=1e-10):
+  P = len(wins)
+  total_wins = wins.sum(axis=1)
+  gamma = np.ones(P)
+  for _ in range(max_iters):
+    denom = (games / (gamma[:,None] + gamma[None,:])).sum(axis=1)
+    new_gamma = total_wins / denom
+    new_gamma /= np.exp(np.log(new_gamma).mean())
+    done = np.abs(new_gamma - gamma).max() < tol
+    gamma = new_gamma
+    if done:
+      break
+  theta = np.log(gamma)
+  p = gamma[:,None] / (gamma[:,None] + gamma[None,:])
+  info = -games * p * (1 - p)
+  info[np.diag_indices(P)] = 0
+  info[np.diag_indices(P)] = -info.sum(axis=1)
+  return theta, np.linalg.pinv(info)
+
+# Conversion of Bradley-Terry log-strengths to Elo points
+ELO_SCALE = 400 / math.log(10)
+
+# =====================================
+
+# A round-robin tournament between the players of roster (a list of names
+# in PLAYERS or network files)
+# num_games: games played by each ordered pair, i.e. with each player as X
+# block_games: games per task of the pool
+# workers: number of processes (1 plays every game in this process)
+# seed: makes the results reproducible, for any number of workers
+# prior: number of virtual ties added to every pairing when rating, so that
+# players that won or lost every game get finite ratings
+class Tournament:
+
+  def __init__(self, roster, num_games=100, block_games=100, workers=1, seed=None, prior=1.0):
+    if len(roster) < 2:
+      raise RuntimeError("A tournament needs at least two players")
+    self.roster = list(roster)
+    self.names = [player_label(spec) for spec in self.roster]
+    self.num_games = num_games
+    self.block_games = block_games
+    self.workers = workers
+    if seed is None:
+      seed = random.randrange(2**32)
+    self.seed = seed
+    self.prior = prior
+    # results[x,o] holds (X wins, ties, O wins) of the games of x against o
+    # with x playing X
+    P = len(self.roster)
+    self.results = np.zeros((P, P, 3), dtype=int)
+
+  # Returns the list of tasks of the tournament: the games of every ordered
+  # pair in blocks, each block with its own seed
+  def tasks(self):
+    tasks = []
+    P = len(self.roster)
+    for x in range(P):
+      for o in range(P):
+        if x == o:
+          continue
+        for first in range(0, self.num_games, self.block_games):
+          num_games = min(self.block_games, self.num_games - first)
+          seed = (self.seed << 40) + len(tasks)
+          tasks.append((x, o, self.roster[x], self.roster[o], num_games, seed))
+    return tasks
+
+  # Plays the tournament, yielding the (x, o, x wins, ties, o wins) of every
+  # block of games as it finishes (in any order) after adding it to results
+  def stream(self):
+    tasks = self.tasks()
+    if self.workers > 1:
+      pool = multiprocessing.Pool(self.workers)
+      blocks = pool.imap_unordered(_play_block_task, tasks)
+    else:
+      pool = None
+      blocks = (_play_block_task(task) for task in tasks)
+    try:
+      for x, o, xwins, ties, owins in blocks:
+        self.results[x,o] += (xwins, ties, owins)
+        yield (x, o, xwins, ties, owins)
+    finally:
+      if pool is not None:
+        pool.close()
+        pool.join()
+
+  # Plays the whole tournament
+  def play(self, report=False):
+    start = datetime.datetime.now()
+    total = len(self.roster) * (len(self.roster) - 1) * self.num_games
+    played = 0
+    for x, o, xwins, ties, owins in self.stream():
+      played += xwins + ties + owins
+      if report:
+        print("{} (X) vs. {} (O): +{} ={} -{}  [{:,}/{:,}]".format(self.names[x], self.names[o],
+          xwins, ties, owins, played, total))
+    if report:
+      elapsed = (datetime.datetime.now() - start).total_seconds()
+      print("{:,} games in {:.2f}s".format(played, elapsed))
+    return self
+
+  # Returns (wins, games): wins[i,j] is the score of i against j over both
+  # colors (ties counting 1/2) and games[i,j] the number of games they played
+  def pair_scores(self):
+    R = self.results
+    wins = R[:,:,0] + R[:,:,2].T + (R[:,:,1] + R[:,:,1].T)/2
+    games = R.sum(axis=2) + R.sum(axis=2).T
+    return wins, games
+
+  # Returns the cross-table: the (P, P) fraction of the points that i scored
+  # against j, NaN where they didn't play
+  def cross_table(self):
+    wins, games = self.pair_scores()
+    with np.errstate(invalid="ignore", divide="ignore"):
+      return np.where(games > 0, wins / games, np.nan)
+
+  # Returns the list of (name, rating, low, high) of the players from best to
+  # worst: Elo ratings fitted with the Bradley-Terry model, and the bounds of
+  # their confidence interval
+  # Ratings average zero, or are relative to the player named anchor
+  def ratings(self, confidence=0.95, anchor=None):
+    wins, games = self.pair_scores()
+    P = len(self.roster)
+    pairs = 1 - np.eye(P)
+    theta, cov = bradley_terry(wins + self.prior*pairs/2, games + self.prior*pairs)
+    var = np.diag(cov).copy()
+    if anchor is not None:
+      if anchor not in self.names:
+        raise RuntimeError("Unknown anchor: %s" % str(anchor))
+      a = self.names.index(anchor)
+      theta = theta - theta[a]
+      var = var + cov[a,a] - 2*cov[:,a]
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    ratings = []
+    for i in np.argsort(-theta, kind="stable"):
+      rating = ELO_SCALE * theta[i]
+      halfwidth = z * ELO_SCALE * math.sqrt(max(var[i], 0))
+      ratings.append((self.names[i], rating, rating - halfwidth, rating + halfwidth))
+    return ratings
+
+  # Prints the cross-table and the ratings
+  def show(self, confidence=0.95, anchor=None):
+    width = max(8, max(len(name) for name in self.names) + 1)
+    print("\nCross-table (score of row vs. column):")
+    print(" " * width + "".join("%*s" % (width, name) for name in self.names))
+    table = self.cross_table()
+    for i, name in enumerate(self.names):
+      cells = ["%*s" % (width, "-") if np.isnan(v) else "%*.3f" % (width, v) for v in table[i]]
+      print("%-*s" % (width, name) + "".join(cells))
+    print("\nRatings (%g%% confidence):" % (100*confidence))
+    for name, rating, low, high in self.ratings(confidence, anchor):
+      print("%-*s %7.1f  [%7.1f, %7.1f]" % (width, name, rating, low, high))
+
+# ==============================================================================
+
+if __name__ == "__main__":
+
+  parser = argparse.ArgumentParser(description="Round-robin tournament between players")
+  parser.add_argument("roster", nargs="+", help="players: %s, or network files" % ", ".join(PLAYERS))
+  parser.add_argument("--games", type=int, default=1000, help="games per pairing and color")
+  parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of processes")
+  parser.add_argument("--seed", type=int, help="seed of the tournament")
+  parser.add_argument("--anchor", help="player rated at 0")
+  args = parser.parse_args()
+
+  tournament = Tournament(args.roster, num_games=args.games, workers=args.workers, seed=args.seed)
+  tournament.play(report=True)
+  tournament.show(anchor=args.anchor)
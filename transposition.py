@@ -0,0 +1,235 @@
+# Transposition caches for MinimaxPlayer that can be shared by several
+# players in a process (through a registry of caches by name) and saved to
+# disk, so that new players and new processes don't start with a cold cache
+# The file is a fixed-layout table of records sorted by key, which is
+# memory-mapped read-only so that worker processes share its pages; entries
+# added while playing are kept in memory up to a cap, evicting the oldest
+# A pickled cache (e.g. inside a player sent to a pool worker) only carries
+# the name of its file and its entries in memory; the worker maps the file
+# again
+import os
+import numpy as np
+from players import EXACT, INFINITY
+
+# ==============================================================================
+
+# File layout: a 64-byte header (magic bytes, uint64 number of records and the
+# configuration string of the cache, null-padded to 48 bytes) followed by the
+# records
+MAGIC = b"TTTTC\x00\x00\x02"
+HEADER_SIZE = 64
+CONFIG_SIZE = 48
+
+# A record (24 bytes): the cache key, the score (a double, so that the
+# heuristic scores of the iterative search are saved exactly), the depth
+# searched (-1 if unlimited) and the bound type
+# Keys must fit in 64 bits, so only caches of boards of up to 31 squares can
+# be saved
+RECORD = np.dtype([("key", "<u8"), ("score", "<f8"), ("depth", "<i2"), ("bound", "i1"), ("pad", "i1"), ("pad2", "<i4")])
+
+# Rough memory use of an in-memory entry (dict slot, key and value objects)
+ENTRY_BYTES = 150
+
+MAX_KEY = 2**64
+
+# =====================================
+
+# A cache of MinimaxPlayer scores, used like the dict of MinimaxPlayer.cache
+# fname: file to load the saved entries from (if it exists) and save to
+# max_entries, max_bytes: caps on the number of entries kept in memory and
+# on their estimated memory use
+# mmap: whether to memory-map the file instead of reading it
+# Entries of the file are looked up by binary search, and copied to memory
+# when used
+# A cache only holds entries of one configuration (search algorithm, board
+# geometry and heuristic), set by the first player that uses it
+class TranspositionCache:
+
+  def __init__(self, fname=None, max_entries=1000000, max_bytes=None, mmap=True):
+    self.fname = fname
+    if max_bytes is not None:
+      max_entries = min(max_entries, max_bytes // ENTRY_BYTES)
+    if max_entries < 1:
+      raise RuntimeError("Invalid cache size: %s" % str(max_entries))
+    self.max_entries = max_entries
+    self.entries = {}
+    self.evictions = 0
+    self.config = None
+    self.search = None
+    self.base = None
+    self.base_keys = None
+    self.base_fname = None
+    self.mmap = mmap
+    if fname is not None and os.path.exists(fname):
+      self.load(fname, mmap=mmap)
+
+  # Pickles everything but the records of the file, which are loaded again
+  # from it when unpickled
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state["base"] = None
+    state["base_keys"] = None
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    if self.base_fname is not None:
+      self.load(self.base_fname, mmap=self.mmap)
+
+  # Sets the configuration of the cache, or checks that it matches
+  def bind(self, search, geometry, heuristic=None):
+    config = "%s %i,%i,%i %s" % (search, geometry[0], geometry[1], geometry[2],
+      "-" if heuristic is None else heuristic.__name__)
+    if len(config.encode()) > CONFIG_SIZE:
+      raise RuntimeError("Cache configuration too long: %s" % config)
+    if self.config is None:
+      self.config = config
+      self.search = search
+    elif config != self.config:
+      raise RuntimeError("Cache is for '%s', not '%s'" % (self.config, config))
+
+  # Returns the value stored for key, or default
+  def get(self, key, default=None):
+    value = self.entries.get(key)
+    if value is not None:
+      return value
+    if self.base is not None and key < MAX_KEY:
+      i = int(np.searchsorted(self.base_keys, np.uint64(key)))
+      if i < len(self.base_keys) and self.base_keys[i] == key:
+        value = self.decode(self.base[i])
+        self[key] = value
+        return value
+    return default
+
+  def __contains__(self, key):
+    return self.get(key) is not None
+
+  def __getitem__(self, key):
+    value = self.get(key)
+    if value is None:
+      raise KeyError(key)
+    return value
+
+  # Stores a value, evicting the oldest entry in memory if the cache is full
+  def __setitem__(self, key, value):
+    entries = self.entries
+    if key not in entries and len(entries) >= self.max_entries:
+      del entries[next(iter(entries))]
+      self.evictions += 1
+    entries[key] = value
+
+  # Number of entries in memory and in the file (counting twice the ones in
+  # both)
+  def __len__(self):
+    return len(self.entries) + (0 if self.base is None else len(self.base))
+
+  # Converts a value of MinimaxPlayer's cache to (score, depth, bound)
+  def encode(self, value):
+    if self.search == "minimax":
+      return value, -1, EXACT
+    elif self.search == "alphabeta":
+      bound, score = value
+      return score, -1, bound
+    else:
+      bound, score, depth = value
+      return score, -1 if depth == INFINITY else depth, bound
+
+  # Converts a record back to a value of MinimaxPlayer's cache
+  def decode(self, record):
+    score = float(record["score"])
+    if score.is_integer():
+      score = int(score)
+    if self.search == "minimax":
+      return score
+    elif self.search == "alphabeta":
+      return (int(record["bound"]), score)
+    else:
+      depth = int(record["depth"])
+      return (int(record["bound"]), score, INFINITY if depth < 0 else depth)
+
+  # Saves the entries of the file and the ones in memory to fname (the file
+  # it was loaded from by default), replacing it atomically
+  def save(self, fname=None):
+    if fname is None:
+      fname = self.fname
+    if fname is None:
+      raise RuntimeError("No file to save the cache to")
+    if self.config is None:
+      raise RuntimeError("Nothing to save: the cache was never used")
+    keys = list(self.entries)
+    if any(key >= MAX_KEY for key in keys):
+      raise RuntimeError("Can't save the cache: keys of '%s' don't fit in 64 bits" % self.config)
+    records = np.zeros(len(keys), dtype=RECORD)
+    for i, key in enumerate(keys):
+      records[i] = (key,) + self.encode(self.entries[key]) + (0, 0)
+    if self.base is not None:
+      # Entries in memory take precedence over the ones of the file
+      base = np.asarray(self.base)
+      keep = ~np.isin(base["key"], np.array(keys, dtype=np.uint64))
+      records = np.concatenate([base[keep], records])
+    records = records[np.argsort(records["key"], kind="stable")]
+    header = MAGIC + np.uint64(len(records)).tobytes() + self.config.encode().ljust(CONFIG_SIZE, b"\x00")
+    tmpfname = fname + ".tmp"
+    f = open(tmpfname, "wb")
+    f.write(header)
+    records.tofile(f)
+    f.close()
+    os.replace(tmpfname, fname)
+
+  # Loads the entries of a file written by save()
+  def load(self, fname, mmap=True):
+    f = open(fname, "rb")
+    header = f.read(HEADER_SIZE)
+    f.close()
+    if len(header) != HEADER_SIZE or header[:len(MAGIC)] != MAGIC:
+      raise RuntimeError("Not a transposition cache file: %s" % fname)
+    count = int(np.frombuffer(header, dtype="<u8", count=1, offset=len(MAGIC))[0])
+    config = header[len(MAGIC)+8:].rstrip(b"\x00").decode()
+    if self.config is not None and config != self.config:
+      raise RuntimeError("Cache is for '%s', not '%s'" % (self.config, config))
+    self.config = config
+    self.search = config.split()[0]
+    self.mmap = mmap
+    self.base_fname = fname
+    if count == 0:
+      self.base = None
+      self.base_keys = None
+      self.base_fname = None
+    elif mmap:
+      self.base = np.memmap(fname, dtype=RECORD, mode="r", offset=HEADER_SIZE, shape=(count,))
+      self.base_keys = self.base["key"]
+    else:
+      self.base = np.fromfile(fname, dtype=RECORD, count=count, offset=HEADER_SIZE)
+      self.base_keys = self.base["key"]
+
+# =====================================
+
+# The caches of this process by name
+_caches = {}
+
+# Returns the cache registered under name, creating it with the given
+# arguments (see TranspositionCache) the first time
+def get_cache(name, fname=None, max_entries=1000000, max_bytes=None, mmap=True):
+  if name not in _caches:
+    _caches[name] = TranspositionCache(fname, max_entries=max_entries, max_bytes=max_bytes, mmap=mmap)
+  return _caches[name]
+
+# ==============================================================================
+
+if __name__ == "__main__":
+
+  import time
+  from players import MinimaxPlayer
+  from tictactoe import GameState
+
+  # The first move of a new player, with a new cache, then with the saved one
+  fname = "minimax.ttc"
+  for run in range(2):
+    cache = TranspositionCache(fname)
+    player = MinimaxPlayer(mark="X", cache=cache)
+    start = time.perf_counter()
+    player.get_play(GameState())
+    elapsed = time.perf_counter() - start
+    print("Run %i: first move in %.2f ms, %i positions explored" % (run+1, 1000*elapsed, player.explored))
+    cache.save()
+  os.remove(fname)
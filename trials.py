@@ -1,27 +1,150 @@
 import datetime
+import multiprocessing
 import random
 import os
+import time
 from tictactoe import *
 from players import *
 from NNPlayer import *
+from instrument import Stats
+from records import GameList
 import numpy as np
 
 # ================================
 
-def evaluate_player(player, num_games, opponent=None, report=False, xs=None):
+# Evaluates the strength of player against opponent (a RandomPlayer by
+# default) by playing num_games games, each started by either at random
+# Returns (strength, wins, ties, losses, elapsed), plus the strength measured
+# after each number of games in xs if given
+# With exact=True no games are played: the probabilities of winning, tying
+# and losing are computed exactly (see evaluate_player_exact) and returned
+# in place of the counts
+# If a seed is given, the random module is reseeded at the start of every
+# block of seed_block games (SEED_BLOCK by default) from the seed and the
+# block number, so results are reproducible; with seed_block=1 every game
+# starts from its own seed, so evaluations of different players with the
+# same seed see the same starting sides and opponent random numbers game by
+# game
+# With workers > 1 the blocks are split across a pool of processes; since
+# each block is seeded from its number, for a fixed seed the results are the
+# same for any number of workers (a seed is drawn if none is given)
+# stats is an optional instrument.Stats that collects the games, moves and
+# search counters of the evaluation (those of the workers are merged in), and
+# its wall time as the "evaluate_player" timer
+# sink is an optional records.RecordWriter that receives every game, in the
+# same order for any number of workers
+def evaluate_player(player, num_games, opponent=None, report=False, xs=None, exact=False, seed=None, workers=1, stats=None, sink=None, seed_block=None):
 
   if opponent is None:
     opponent = RandomPlayer(quiet=True)
 
+  if exact:
+    return evaluate_player_exact(player, opponent, xs=xs)
+
   if xs is not None:
     ys = []
+    xs = set(xs)
+
+  if seed_block is None:
+    seed_block = SEED_BLOCK
 
   wins = 0
   ties = 0
   losses = 0
   start = datetime.datetime.now()
+  if stats is not None:
+    wall_start = time.perf_counter()
+
+  # Split the games in chunks of whole seed blocks, played in order here or
+  # by the pool
+  num_blocks = (num_games + seed_block - 1) // seed_block
+  num_chunks = min(num_blocks, max(20, 4*workers))
+  bounds = [1 + seed_block*(num_blocks*c // num_chunks) for c in range(num_chunks)]
+  bounds.append(num_games+1)
+  if workers > 1:
+    if seed is None:
+      seed = random.randrange(2**32)
+    profile = stats is not None
+    record = sink is not None
+    tasks = [(player, opponent, bounds[c], bounds[c+1], seed, profile, record, seed_block) for c in range(num_chunks)]
+    pool = multiprocessing.Pool(workers)
+    chunks = pool.imap(_play_games_task, tasks)
+  else:
+    pool = None
+    chunks = ((play_games(player, opponent, bounds[c], bounds[c+1], seed, stats, sink, seed_block), None, None) for c in range(num_chunks))
+
+  # The pool is cleaned up even if a worker, stats or sink raises
+  ntrial = 0
+  try:
+    for outcomes, chunk_stats, chunk_games in chunks:
+
+      if chunk_stats is not None:
+        stats.merge(chunk_stats)
+      if chunk_games is not None:
+        for game in chunk_games.games:
+          sink.add(*game)
+
+      for outcome in outcomes:
+
+        ntrial += 1
+        if outcome == WIN:
+          wins += 1
+        elif outcome == LOSS:
+          losses += 1
+        else:
+          ties += 1
+
+        if xs is not None:
+          if ntrial in xs:
+            strength = (wins + ties/2) / ntrial
+            ys.append(strength)
+            if report: print("{:,} {:.7f}".format(ntrial, strength))
+
+      if report:
+        print("{:,}/{:,} ({:.0f}%)".format(ntrial, num_games, 100*ntrial/num_games))
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+
+  strength = (wins + ties/2) / ntrial
+  elapsed = (datetime.datetime.now() - start).total_seconds()
+  results = (strength, wins, ties, losses, elapsed)
+  if xs is not None:
+    results += (ys,)
+  if stats is not None:
+    stats.record_time("evaluate_player", time.perf_counter() - wall_start)
+
+  return results
 
-  for ntrial in range(1,num_games+1):
+# Outcomes of a game for the evaluated player
+LOSS = 0
+TIE = 1
+WIN = 2
+
+# Number of consecutive games played from each seed
+SEED_BLOCK = 100
+
+# Plays games number first to last-1 of an evaluation and returns their
+# outcomes for player as a bytearray of LOSS, TIE or WIN
+# If seed is not None the random module is seeded with block_seed() at the
+# start of each block of seed_block games; first must then start a block
+# If stats is given the games are recorded in it, and so are the counters of
+# the players that have a stats attribute (for the duration of the games)
+# If sink is given every game is passed to it (see TicTacToe)
+def play_games(player, opponent, first, last, seed=None, stats=None, sink=None, seed_block=SEED_BLOCK):
+
+  if stats is not None:
+    searchers = [p for p in {id(player): player, id(opponent): opponent}.values() if hasattr(p, "stats")]
+    saved = [p.stats for p in searchers]
+    for p in searchers:
+      p.stats = stats
+
+  outcomes = bytearray()
+  for ntrial in range(first, last):
+
+    if seed is not None and (ntrial-1) % seed_block == 0:
+      random.seed(block_seed(seed, (ntrial-1) // seed_block))
 
     # Determine starting player
     starting = random.random() > 0.5
@@ -32,34 +155,110 @@ def evaluate_player(player, num_games, opponent=None, report=False, xs=None):
       playerX = opponent
       playerO = player
 
-    game = TicTacToe(playerX, playerO, quiet=True)
+    game = TicTacToe(playerX, playerO, quiet=True, stats=stats, sink=sink)
     winner = game.play()
 
     if winner == player.mark:
-      wins += 1
+      outcomes.append(WIN)
     elif winner == opponent.mark:
-      losses += 1
+      outcomes.append(LOSS)
     else:
-      ties += 1
+      outcomes.append(TIE)
 
-    if report:
-      if ntrial % (num_games//20) == 0:
-        print("{:,}/{:,} ({:.0f}%)".format(ntrial, num_games, 100*ntrial/num_games))
+  if stats is not None:
+    for p, p_stats in zip(searchers, saved):
+      p.stats = p_stats
 
-    if xs is not None:
-      if ntrial in xs:
-        strength = (wins + ties/2) / ntrial
-        ys.append(strength)
-        if report: print("{:,} {:.7f}".format(ntrial, strength))
+  return outcomes
 
-  strength = (wins + ties/2) / ntrial
+# Returns the seed of block number block of an evaluation with the given seed
+def block_seed(seed, block):
+  return (seed << 40) + block
+
+# Entry point of the pool workers in evaluate_player
+# Returns the outcomes, the worker's Stats of the games (None if not
+# profiling) and the GameList of the games (None if not recording)
+def _play_games_task(args):
+  player, opponent, first, last, seed, profile, record, seed_block = args
+  stats = Stats() if profile else None
+  games = GameList() if record else None
+  return play_games(player, opponent, first, last, seed, stats, games, seed_block), stats, games
+
+# Computes the exact probabilities that player wins, ties or loses a game
+# against opponent, each starting with probability 1/2, by walking the game
+# tree once and weighting each play by its probability
+# Players that implement get_play_distribution() contribute all their
+# possible plays; any other player is assumed to be deterministic and only
+# its get_play() is followed, unless it sets deterministic = False, in
+# which case it can't be evaluated exactly and a RuntimeError is raised
+# Returns (strength, wins, ties, losses, elapsed) with probabilities in place
+# of counts, plus the (constant) strength for each number of games in xs
+def evaluate_player_exact(player, opponent, xs=None):
+
+  for p in (player, opponent):
+    if not hasattr(p, "get_play_distribution") and not getattr(p, "deterministic", True):
+      raise RuntimeError("%s plays at random and can't be evaluated exactly" % p.name)
+
+  start = datetime.datetime.now()
+
+  wins = 0
+  ties = 0
+  losses = 0
+  for starting in [True, False]:
+    if starting:
+      playerX = player
+      playerO = opponent
+    else:
+      playerX = opponent
+      playerO = player
+    playerX.mark = "X"
+    playerO.mark = "O"
+    probs = outcome_probabilities(GameState(), "X", playerX, playerO, {})
+    wins += probs[player.mark] / 2
+    ties += probs["tie"] / 2
+    losses += probs[opponent.mark] / 2
+
+  strength = wins + ties/2
   elapsed = (datetime.datetime.now() - start).total_seconds()
   results = (strength, wins, ties, losses, elapsed)
   if xs is not None:
-    results += (ys,)
+    results += ([strength]*len(xs),)
 
   return results
 
+# Returns a dict with the probabilities of each result ("X", "O" or "tie")
+# of the game continuing from state with to_play to play
+# Results are memoized by position in cache, since the players only see the
+# position and not how it was reached
+def outcome_probabilities(state, to_play, playerX, playerO, cache):
+
+  winner = state.get_winner()
+  if winner is not None:
+    probs = {"X": 0.0, "O": 0.0, "tie": 0.0}
+    probs[winner] = 1.0
+    return probs
+
+  key = state.key()
+  if key in cache:
+    return cache[key]
+
+  player = playerX if to_play == "X" else playerO
+  if hasattr(player, "get_play_distribution"):
+    distribution = player.get_play_distribution(state)
+  else:
+    distribution = [(player.get_play(state), 1.0)]
+
+  next_player = "O" if to_play == "X" else "X"
+  probs = {"X": 0.0, "O": 0.0, "tie": 0.0}
+  for play, prob in distribution:
+    new_state = state.try_play_at(to_play, play)
+    sub_probs = outcome_probabilities(new_state, next_player, playerX, playerO, cache)
+    for result in probs:
+      probs[result] += prob * sub_probs[result]
+
+  cache[key] = probs
+  return probs
+
 # ================================
 
 if __name__ == "__main__":
@@ -78,7 +277,7 @@ if __name__ == "__main__":
 
     print("Player:", player.name)
 
-    strength, wins, ties, losses, elapsed, ys = evaluate_player(player, num_games=num_games, report=True, xs=xs)
+    strength, wins, ties, losses, elapsed, ys = evaluate_player(player, num_games=num_games, report=True, xs=xs, workers=os.cpu_count())
 
     print("Wins: %i (%.1f%%)" % (wins, 100*wins/num_games))
     print("Ties: %i (%.1f%%)" % (ties, 100*ties/num_games))